@@ -0,0 +1,176 @@
+"""asyncio Kafka consumer worker (Python 3 only)"""
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from confluent_kafka import KafkaError, KafkaException
+
+from jangl_utils import logger, sentry
+from jangl_utils.kafka import utils
+from jangl_utils.kafka.consumers import ConsumerSettingsMixin, DeferredAvroConsumer, MessageValue
+from jangl_utils.kafka.offsets import OffsetTracker
+from jangl_utils.workers.aio import AsyncWorker
+
+__all__ = ['AsyncKafkaWorker']
+
+
+class AsyncKafkaWorker(ConsumerSettingsMixin, AsyncWorker):
+    """Avro consumer worker for asyncio
+
+    Implement ``async def consume_message(self, message)``. Every message gets its
+    own task, up to ``concurrency`` at a time; beyond that the assigned partitions are
+    paused while polling continues, and resumed once half the tasks are done.
+
+    librdkafka calls block, so each worker runs its consumer on a dedicated thread;
+    polling and Avro decoding happen there and never block the event loop. The
+    rebalance callbacks on_assign and on_revoke run on that thread as well.
+
+    With commit_on_complete, offsets are committed every ``commit_interval`` seconds,
+    up to the first message that isn't done yet in each partition.
+
+    The group id and consumer settings, including cooperative_rebalance and
+    static_membership, work as in KafkaWorker.
+    """
+    topic_name = None
+    commit_on_complete = False
+    commit_interval = 1
+    poll_timeout = 0.5
+    concurrency = 100
+    drain_timeout = 10
+    consumer = None
+    executor = None
+    failure = None
+
+    async def setup(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.tasks = set()
+        self.offsets = OffsetTracker()
+        self.offsets_lock = threading.Lock()
+        self.failure = None
+        self.paused = False
+        self.last_commit = time.time()
+        self.consumer = await self.call(self.get_consumer)
+        await self.call(self.consumer.subscribe, [self.get_topic_name()],
+                        on_assign=self.on_assign, on_revoke=self.on_revoke)
+
+    async def teardown(self):
+        if self.tasks:
+            done, pending = await asyncio.wait(self.tasks, timeout=self.drain_timeout)
+            for task in pending:
+                task.cancel()
+        if self.consumer is not None:
+            if self.commit_on_complete and self.failure is None:
+                await self.commit(asynchronous=False)
+            await self.call(self.consumer.close)
+            self.consumer = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def call(self, func, *args, **kwargs):
+        """Run a blocking consumer call on the consumer thread"""
+        return self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def get_consumer(self):
+        return DeferredAvroConsumer(self.get_consumer_settings())
+
+    def get_topic_name(self):
+        return self.topic_name or utils.config_missing('topic name')
+
+    async def handle(self):
+        if self.failure is not None:
+            raise self.failure
+
+        await self.flow_control()
+        message = await self.call(self.poll)
+
+        if message is None:
+            pass
+
+        elif message.error():
+            if message.error().code() == KafkaError._PARTITION_EOF:
+                await self.partition_eof(message)
+            else:
+                raise KafkaException(message.error())
+
+        else:
+            with self.offsets_lock:
+                self.offsets.add(message)
+            task = self.loop.create_task(self.process_message(message))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        if self.commit_on_complete and time.time() - self.last_commit >= self.commit_interval:
+            await self.commit()
+
+        self.metrics.gauge('tasks').set(len(self.tasks))
+        await self.done()
+
+    def poll(self):
+        """Poll and decode one message, runs on the consumer thread"""
+        message = self.consumer.poll(self.poll_timeout)
+        if message is not None and not message.error():
+            self.consumer.decode(message)
+        return message
+
+    async def flow_control(self):
+        if not self.paused and len(self.tasks) >= self.concurrency:
+            logger.info('%d messages in flight, pausing consumption', len(self.tasks))
+            await self.call(lambda: self.consumer.pause(self.consumer.assignment()))
+            self.paused = True
+
+        elif self.paused and len(self.tasks) <= self.concurrency // 2:
+            logger.info('%d messages in flight, resuming consumption', len(self.tasks))
+            await self.call(lambda: self.consumer.resume(self.consumer.assignment()))
+            self.paused = False
+
+    async def process_message(self, message):
+        start = time.time()
+        try:
+            await self.consume_message(MessageValue(message))
+        except Exception as exc:
+            logger.error('failed to consume %s [%d] offset %d: %r',
+                         message.topic(), message.partition(), message.offset(), exc, exc_info=True)
+            sentry.captureException()
+            self.metrics.counter('messages_failed').inc()
+            self.failure = exc
+            return
+        finally:
+            self.metrics.histogram('message_seconds').observe(time.time() - start)
+
+        self.metrics.counter('messages_consumed').inc()
+        with self.offsets_lock:
+            self.offsets.done(message)
+
+    async def commit(self, asynchronous=True):
+        self.last_commit = time.time()
+        if self.consumer_settings.get('enable.auto.commit'):
+            return
+        with self.offsets_lock:
+            offsets = self.offsets.committable()
+        if offsets:
+            await self.call(self.consumer.commit, offsets=offsets, asynchronous=asynchronous)
+
+    def on_assign(self, consumer, partitions):
+        logger.info('partitions assigned: %s', partitions)
+
+    def on_revoke(self, consumer, partitions):
+        """Commit what is done of the revoked partitions, messages still in flight will be redelivered"""
+        logger.info('partitions revoked: %s', partitions)
+        with self.offsets_lock:
+            offsets = self.offsets.committable(partitions)
+            self.offsets.revoke(partitions)
+        if offsets and self.commit_on_complete and not self.consumer_settings.get('enable.auto.commit'):
+            try:
+                consumer.commit(offsets=offsets, asynchronous=False)
+            except KafkaException as exc:
+                logger.warning('commit on revoke failed: %s', exc)
+
+    async def consume_message(self, message):
+        pass
+
+    async def partition_eof(self, message):
+        pass
@@ -0,0 +1,187 @@
+import io
+import json
+import struct
+
+import fastavro
+import six
+
+numpy = None
+try:
+    import numpy
+except ImportError:
+    pass
+
+pyarrow = None
+try:
+    import pyarrow
+except ImportError:
+    pass
+
+__all__ = ['ColumnBatch', 'ColumnarDecoder', 'batch_from_records']
+
+AVRO_DTYPES = {
+    'int': 'int32',
+    'long': 'int64',
+    'float': 'float32',
+    'double': 'float64',
+    'boolean': 'bool',
+}
+NULLABLE_NUMERIC = {'int', 'long', 'float', 'double'}
+# Fill for nulls, tombstones and fields missing from other schema versions, by dtype kind
+MISSING_VALUES = {'f': float('nan'), 'i': 0, 'b': False}
+
+
+class ColumnBatch(object):
+    """A batch of messages with one NumPy array per value field
+
+    ``columns`` maps each field of the value schema to an array. Message
+    metadata is available as the ``topics``, ``partitions``, ``offsets``,
+    ``timestamps`` (unix ms) and ``keys`` arrays.
+    """
+
+    def __init__(self, columns, topics, partitions, offsets, timestamps, keys):
+        self.columns = columns
+        self.topics = topics
+        self.partitions = partitions
+        self.offsets = offsets
+        self.timestamps = timestamps
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __contains__(self, field):
+        return field in self.columns
+
+    @property
+    def fields(self):
+        return list(self.columns)
+
+    def to_arrow(self):
+        if pyarrow is None:
+            raise ImportError('pyarrow is required for ColumnBatch.to_arrow()')
+        names = list(self.columns)
+        return pyarrow.RecordBatch.from_arrays([pyarrow.array(self.columns[name]) for name in names], names)
+
+    @classmethod
+    def from_messages(cls, messages, columns, get_record, decode_key=None):
+        """Fill preallocated ``columns`` from the dicts get_record() returns per message"""
+        size = len(messages)
+        topics = numpy.empty(size, dtype=object)
+        partitions = numpy.empty(size, dtype='int32')
+        offsets = numpy.empty(size, dtype='int64')
+        timestamps = numpy.empty(size, dtype='int64')
+        keys = numpy.empty(size, dtype=object)
+        fields = [(name, column, MISSING_VALUES.get(column.dtype.kind)) for name, column in columns.items()]
+
+        for row, message in enumerate(messages):
+            topics[row] = message.topic()
+            partitions[row] = message.partition()
+            offsets[row] = message.offset()
+            timestamps[row] = message.timestamp()[1]
+            key = message.key()
+            keys[row] = decode_key(key) if decode_key is not None and key is not None else key
+
+            record = get_record(message) or {}
+            for name, column, missing in fields:
+                field_value = record.get(name)
+                column[row] = missing if field_value is None else field_value
+
+        return cls(columns, topics, partitions, offsets, timestamps, keys)
+
+
+def batch_from_records(messages):
+    """A ``ColumnBatch`` of messages whose values are already dicts, as replayed from files
+
+    Fields come from the first value. A field whose values are all booleans, ints
+    or floats gets a native dtype, float64 with NaN when some are null; anything
+    else is an object column.
+    """
+    if numpy is None:
+        raise ImportError('numpy is required for columnar batches')
+    values = [message.value() for message in messages]
+    first_value = next((value for value in values if value is not None), None) or {}
+    columns = {}
+    for name in first_value:
+        column = [value.get(name) if value is not None else None for value in values]
+        columns[name] = numpy.empty(len(values), dtype=guess_dtype(column))
+    return ColumnBatch.from_messages(messages, columns, lambda message: message.value())
+
+
+def guess_dtype(values):
+    types = set(type(value) for value in values if value is not None)
+    nullable = any(value is None for value in values)
+    if types == {bool} and not nullable:
+        return 'bool'
+    if types and types <= set(six.integer_types) and not nullable:
+        return 'int64'
+    if types and types <= set(six.integer_types) | {float}:
+        return 'float64'
+    return object
+
+
+class ColumnarDecoder(object):
+    """Decodes schema registry framed Avro values into column arrays
+
+    Each value is decoded by fastavro's schemaless reader into a dict whose fields
+    are copied into preallocated arrays, so the batch is transposed into columns
+    rather than decoded without dicts. Column dtypes come from the writer schema
+    of the first message: ints, longs, floats, doubles and booleans get native
+    dtypes, nullable numbers become float64 with NaN for null, and everything
+    else is an object column. Tombstones, and records of other schema versions
+    lacking a field, are filled with NaN, 0, False or None.
+    """
+    header = struct.Struct('>bI')
+
+    def __init__(self, registry_client):
+        if numpy is None:
+            raise ImportError('numpy is required for columnar batches')
+        self.registry_client = registry_client
+        self.schemas = {}
+
+    def decode(self, messages, decode_key=None):
+        first_value = next((message.value() for message in messages if message.value() is not None), None)
+        columns = {}
+        if first_value is not None:
+            schema = self.get_schema(self.read_header(first_value))
+            columns = dict((name, numpy.empty(len(messages), dtype=dtype)) for name, dtype in schema['dtypes'])
+        return ColumnBatch.from_messages(messages, columns, self.read_record, decode_key)
+
+    def read_record(self, message):
+        value = message.value()
+        if value is None:
+            return None
+        schema = self.get_schema(self.read_header(value))
+        return fastavro.schemaless_reader(io.BytesIO(value[self.header.size:]), schema['parsed'])
+
+    def read_header(self, value):
+        magic, schema_id = self.header.unpack_from(value)
+        if magic != 0:
+            raise ValueError('Message does not start with the schema registry magic byte')
+        return schema_id
+
+    def get_schema(self, schema_id):
+        schema = self.schemas.get(schema_id)
+        if schema is None:
+            schema_json = json.loads(str(self.registry_client.get_by_id(schema_id)))
+            schema = self.schemas[schema_id] = {
+                'parsed': fastavro.parse_schema(schema_json),
+                'dtypes': [(field['name'], get_dtype(field['type'])) for field in schema_json.get('fields', [])],
+            }
+        return schema
+
+
+def get_dtype(avro_type):
+    if isinstance(avro_type, dict):
+        if avro_type.get('logicalType'):
+            return object
+        avro_type = avro_type.get('type')
+    if isinstance(avro_type, list):
+        types = [t for t in avro_type if t != 'null']
+        if len(types) == 1 and types[0] in NULLABLE_NUMERIC:
+            return 'float64'
+        return object
+    return AVRO_DTYPES.get(avro_type, object)
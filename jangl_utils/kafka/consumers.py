@@ -1,56 +1,346 @@
-from confluent_kafka import (KafkaError, KafkaException, TopicPartition,
+import time
+from collections import deque
+
+import gevent
+from gevent.pool import Pool
+from confluent_kafka import (Consumer, KafkaError, KafkaException, Producer as ConfluentProducer, TopicPartition,
                              OFFSET_BEGINNING, OFFSET_END, TIMESTAMP_NOT_AVAILABLE)
 from confluent_kafka.avro import AvroConsumer
+from confluent_kafka.avro.serializer import SerializerError
+from jangl_utils import logger, sentry
 from jangl_utils.kafka import utils
+from jangl_utils.kafka.columnar import ColumnarDecoder
+from jangl_utils.kafka.dedupe import BloomFilter, MessageDeduplicator
+from jangl_utils.kafka.filters import MessageFilter, decode_headers
+from jangl_utils.kafka.offsets import OffsetTracker
 from jangl_utils.kafka.old_consumer import KafkaConsumerWorker
+from jangl_utils.kafka.producers import flush_all_producers
 from jangl_utils.unix_time import unix_to_dt, dt_to_unix_ms
-from jangl_utils.workers import BaseWorker
+from jangl_utils.workers import BaseWorker, shutdown
+
+__all__ = ['ConsumerSettingsMixin', 'KafkaWorker', 'StartAtBeginningKafkaWorker', 'StartAtEndKafkaWorker',
+           'MultiTopicKafkaWorker', 'MessageValue', 'KafkaConsumerWorker', 'DeferredAvroConsumer']
+
+RETRY_ATTEMPT_HEADER = 'jangl-retry-attempt'
+RETRY_NOT_BEFORE_HEADER = 'jangl-retry-not-before'
+RETRY_ERROR_HEADER = 'jangl-retry-error'
+ORIGINAL_TOPIC_HEADER = 'jangl-original-topic'
+ORIGINAL_PARTITION_HEADER = 'jangl-original-partition'
+ORIGINAL_OFFSET_HEADER = 'jangl-original-offset'
+# Stands for a key the filters did not need to decode
+UNDECODED = object()
+
+
+class DeferredAvroConsumer(AvroConsumer):
+    """AvroConsumer that leaves messages encoded until ``decode`` is called
+
+    Keeping the raw bytes around lets failed messages be forwarded to retry
+    topics exactly as they were received.
+    """
+    _columnar_decoder = None
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        return Consumer.poll(self, timeout)
+
+    def decode(self, message, key=UNDECODED):
+        """Decode the message in place, reusing ``key`` when it was already decoded"""
+        try:
+            if message.value() is not None:
+                message.set_value(self._serializer.decode_message(message.value(), is_key=False))
+            if key is not UNDECODED:
+                message.set_key(key)
+            elif message.key() is not None:
+                message.set_key(self._serializer.decode_message(message.key(), is_key=True))
+        except SerializerError as exc:
+            raise SerializerError('Message deserialization failed for message at {} [{}] offset {}: {}'
+                                  .format(message.topic(), message.partition(), message.offset(), exc))
+        return message
 
-__all__ = ['KafkaWorker', 'StartAtBeginningKafkaWorker', 'StartAtEndKafkaWorker', 'MessageValue', 'KafkaConsumerWorker']
+    def decode_key(self, message):
+        """Decode the key of a raw message without touching the message"""
+        return self._serializer.decode_message(message.key(), is_key=True)
 
+    def decode_columns(self, messages):
+        """Decode a batch of raw messages into a ``ColumnBatch``"""
+        if self._columnar_decoder is None:
+            self._columnar_decoder = ColumnarDecoder(self._serializer.registry_client)
+        return self._columnar_decoder.decode(
+            messages, decode_key=lambda key: self._serializer.decode_message(key, is_key=True))
 
-class KafkaWorker(BaseWorker):
-    topic_name = None
+
+class ConsumerSettingsMixin(object):
+    """Consumer group id and settings shared by KafkaWorker and AsyncKafkaWorker
+
+    Needs the worker's worker_name and get_worker_identity().
+    """
     consumer_name = None
+    ephemeral_consumer = False
     consumer_settings = {}
+    auto_offset_reset = 'earliest'
+    cooperative_rebalance = False
+    static_membership = False
+    static_session_timeout_ms = 45000
+
+    def get_consumer_name(self):
+        if self.consumer_name:
+            return self.consumer_name
+        if self.ephemeral_consumer:
+            return utils.generate_random_consumer_name()
+        return utils.generate_consumer_name(self.worker_name or self.__class__.__name__)
+
+    def get_consumer_settings(self):
+        default_settings = {
+            'group.id': self.get_consumer_name(),
+            'default.topic.config': {'auto.offset.reset': self.auto_offset_reset},
+            'enable.auto.commit': False,
+            'bootstrap.servers': utils.get_broker_url(),
+            'schema.registry.url': utils.get_schema_registry_url(),
+            'session.timeout.ms': 10000,
+            'heartbeat.interval.ms': 1000,
+            'api.version.request': True,
+        }
+        if self.cooperative_rebalance:
+            default_settings['partition.assignment.strategy'] = 'cooperative-sticky'
+        if self.static_membership:
+            default_settings['group.instance.id'] = self.get_worker_identity()
+            default_settings['session.timeout.ms'] = self.static_session_timeout_ms
+        return utils.generate_client_settings(default_settings, self.consumer_settings)
+
+
+class KafkaWorker(ConsumerSettingsMixin, BaseWorker):
+    """Avro consumer worker
+
+    Without a consumer_name the group id is built from KAFKA_SERVICE_NAME, KAFKA_DEPLOYMENT_NAME
+    and the worker_name or class name. Offsets are only committed with commit_on_complete
+    (or enable.auto.commit in consumer_settings); without it a restart starts over from
+    auto_offset_reset even though the group id is stable.
+    Set ephemeral_consumer to join a new random group on every start instead, for workers
+    where every instance must see every message and history doesn't matter.
+
+    Failed messages can be parked instead of restarting the consumer:
+    - retry_topics: A list of (topic_name, delay_seconds). A message that raises one of
+      ``retry_exceptions`` is forwarded to the next retry topic, which this worker also
+      consumes once the delay has passed. Only the delayed retry partition is paused.
+    - dead_letter_topic: Where messages go once the retry topics are exhausted, or
+      immediately if they cannot be decoded.
+    The worker waits up to ``retry_delivery_timeout`` seconds for the broker to acknowledge
+    a forwarded message before moving on; a forward that fails raises, so the offset of the
+    message is not committed and it is consumed again after the restart.
+
+    Messages can be skipped by key or header before their value is decoded:
+    - accept_keys: The keys to consume; a collection of keys, a single key, a compiled
+      regex matched against the key, or a callable taking the key.
+    - accept_headers: A dict of header name to accepted values, in the same forms. Header
+      values are decoded as utf-8 text, and a missing header is tested as None.
+    - accept(key, headers): Define this method for anything the specs above can't express.
+    Skipped messages still count as handled, so their offsets get committed.
+
+    Duplicates replayed after a rebalance can be skipped before decoding:
+    - dedupe_cache_size: Enables deduplication with an LRU of this many message ids.
+    - dedupe_bloom_path: Also remember ids in a memory-mapped Bloom filter at this path,
+      so duplicates are still caught after a restart.
+    - get_message_id: Override to dedupe by a key or header instead of (topic, partition, offset).
+
+    message_source replaces the Kafka consumer with another source of messages, such as
+    a ``jangl_utils.kafka.sources.NDJSONFileSource`` for offline load tests. It is a
+    callable returning the source, and can also be passed as a keyword argument to spawn().
+
+    Setting concurrency handles messages in a pool of that many greenlets. Messages polled
+    while the pool is busy are buffered; once ``max_buffered`` messages are buffered or in
+    flight the assigned partitions are paused, and they resume below ``resume_buffered``.
+    The worker keeps polling while paused so the consumer stays in the group. Only offsets
+    whose messages, and every earlier message, are done get committed.
+
+    Rebalancing:
+    - cooperative_rebalance: Use the cooperative-sticky assignor, so a rebalance only moves
+      the partitions that change owner and the rest keep consuming.
+    - static_membership: Join with a group.instance.id built from get_worker_identity(), so
+      a worker that restarts within the session timeout gets its partitions back without
+      a rebalance. Set WORKER_IDENTITY to something stable, like a StatefulSet pod name.
+      Recycling a worker with recycle_after_handled (counted in messages) or
+      recycle_after_seconds closes its consumer, so it needs static_membership to avoid
+      a rebalance every time.
+    State kept per partition (retry pauses, buffered messages, tracked offsets) is only
+    dropped for the partitions that are revoked.
+
+    Setting batch_size consumes up to that many messages at a time and passes them to
+    consume_messages(), which calls consume_message() for each by default. With
+    batch_columnar, consume_messages() instead receives a ``ColumnBatch`` holding one
+    NumPy array per value field, each decoded value's fields copied into the arrays.
+    Retry topics do not apply in batch mode; a failing batch restarts the worker.
+
+    commit_interval commits at most once per that many seconds instead of after every
+    message; the last handled offsets are still committed on shutdown and revoke.
+
+    Setting catch_up_lag makes the worker check its lag against the high watermarks every
+    ``catch_up_check_interval`` seconds. Once it is that many messages behind, it switches to
+    a catch-up profile until the lag drops to ``catch_up_exit_lag`` (a tenth of catch_up_lag
+    by default): messages are fetched ``catch_up_batch_size`` at a time and commits happen every
+    ``catch_up_commit_interval`` seconds. With static_membership and without a pool, the
+    consumer is also rebuilt with ``catch_up_consumer_settings`` (larger fetches) applied;
+    without static membership that would rebalance the group twice, so the fetch settings
+    stay as they are.
+    """
+    topic_name = None
     commit_on_complete = False
     async_commit = True
     poll_timeout = 0
-    auto_offset_reset = 'earliest'
     consumer = None
     last_message = None
+    retry_topics = ()
+    dead_letter_topic = None
+    retry_exceptions = (Exception,)
+    retry_producer_settings = {}
+    retry_producer = None
+    retry_delivery_timeout = 30
+    dedupe_cache_size = None
+    dedupe_bloom_path = None
+    dedupe_bloom_capacity = 10000000
+    dedupe_bloom_error_rate = 1e-6
+    deduplicator = None
+    accept_keys = None
+    accept_headers = {}
+    accept = None
+    message_filter = None
+    message_source = None
+    concurrency = None
+    max_buffered = None
+    resume_buffered = None
+    drain_timeout = 10
+    pool = None
+    failure = None
+    batch_size = None
+    batch_columnar = False
+    commit_interval = 0
+    catch_up_lag = None
+    catch_up_exit_lag = None
+    catch_up_check_interval = 30
+    catch_up_batch_size = 500
+    catch_up_commit_interval = 5
+    catch_up_consumer_settings = {
+        'fetch.min.bytes': 1024 * 1024,
+        'max.partition.fetch.bytes': 8 * 1024 * 1024,
+    }
 
     def setup(self):
-        self.consumer = AvroConsumer(self.get_consumer_settings())
-        self.consumer.subscribe([self.get_topic_name()])
+        self.paused_retries = {}
+        self.flow_paused = False
+        self.failure = None
+        self.handling = False
+        self.commit_pending = False
+        self.revoke_commit = True
+        self.last_commit = time.time()
+        self.catching_up = False
+        self.next_lag_check = time.time() + self.catch_up_check_interval
+        self.filtered_messages = 0
+        self.message_filter = self.get_message_filter()
+        if self.concurrency:
+            self.pool = Pool(self.concurrency)
+            self.buffer = deque()
+            self.offsets = OffsetTracker()
+        self.retry_topic_names = frozenset(topic for topic, delay in self.get_retry_topics())
+        self.consumer = self.get_message_source() or DeferredAvroConsumer(self.get_consumer_settings())
+        self.subscribe()
+        if self.retry_enabled():
+            self.retry_producer = self.get_retry_producer()
+        if self.dedupe_cache_size:
+            self.deduplicator = self.get_deduplicator()
+
+    def subscribe(self):
+        self.consumer.subscribe(self.get_subscribed_topics(), on_assign=self.on_assign, on_revoke=self.on_revoke)
 
     def teardown(self):
+        """Finish in-flight messages, deliver what they produced, then commit, within the shutdown deadline"""
+        if self.pool is not None:
+            self.pool.join(timeout=shutdown.remaining(self.drain_timeout))
+            self.pool.kill()
+
+        undelivered = flush_all_producers(shutdown.remaining(self.drain_timeout))
+        if self.retry_producer:
+            undelivered += utils.flush_producer(self.retry_producer, shutdown.remaining(self.drain_timeout))
+        if undelivered:
+            logger.warning('not committing offsets, %d produced messages were not delivered', undelivered)
+
+        elif self.pool is not None:
+            if self.commit_on_complete and self.failure is None:
+                self.commit(asynchronous=False)
+        elif self.commit_pending and self.consumer and not self.handling:
+            # Everything polled has been handled, only the deferred commit is missing
+            try:
+                self.commit(asynchronous=False)
+            except KafkaException as exc:
+                logger.warning('commit on teardown failed: %s', exc)
+        self.pool = None
+
+        if self.deduplicator:
+            self.deduplicator.close()
         if self.consumer:
+            # Whatever was safe to commit is committed, closing must not commit past a failed message
+            self.revoke_commit = False
             self.consumer.close()
 
     def get_topic_name(self):
         return self.topic_name or utils.config_missing('topic name')
 
-    def get_consumer_name(self):
-        return self.consumer_name or utils.generate_random_consumer_name()
+    def get_message_source(self):
+        source = self.kwargs.get('message_source') or self.message_source
+        if source is not None:
+            return source() if callable(source) else source
+
+    def get_retry_topics(self):
+        return self.retry_topics
+
+    def get_dead_letter_topic(self):
+        return self.dead_letter_topic
+
+    def get_subscribed_topics(self):
+        return [self.get_topic_name()] + [topic for topic, delay in self.get_retry_topics()]
+
+    def retry_enabled(self):
+        return bool(self.get_retry_topics() or self.get_dead_letter_topic())
 
     def get_consumer_settings(self):
+        consumer_settings = super(KafkaWorker, self).get_consumer_settings()
+        if self.catching_up:
+            consumer_settings = utils.generate_client_settings(consumer_settings, self.catch_up_consumer_settings)
+        return consumer_settings
+
+    def get_retry_producer(self):
+        return ConfluentProducer(self.get_retry_producer_settings())
+
+    def get_retry_producer_settings(self):
         default_settings = {
-            'group.id': self.get_consumer_name(),
-            'default.topic.config': {'auto.offset.reset': self.auto_offset_reset},
-            'enable.auto.commit': False,
             'bootstrap.servers': utils.get_broker_url(),
-            'schema.registry.url': utils.get_schema_registry_url(),
-            'session.timeout.ms': 10000,
-            'heartbeat.interval.ms': 1000,
             'api.version.request': True,
+            'client.id': 'JanglRetryProducer',
+            'default.topic.config': {'request.required.acks': 'all'},
+            'queue.buffering.max.ms': 100,
         }
-        return utils.generate_client_settings(default_settings, self.consumer_settings)
+        return utils.generate_client_settings(default_settings, self.retry_producer_settings)
+
+    def get_deduplicator(self):
+        bloom_filter = None
+        if self.dedupe_bloom_path:
+            bloom_filter = BloomFilter(self.dedupe_bloom_path, self.dedupe_bloom_capacity,
+                                       self.dedupe_bloom_error_rate)
+        return MessageDeduplicator(self.dedupe_cache_size, bloom_filter)
+
+    def get_message_filter(self):
+        if self.accept_keys is not None or self.accept_headers:
+            return MessageFilter(self.accept_keys, self.accept_headers)
 
-    def poll(self):
+    def get_message_id(self, message):
+        """Identifies a raw (undecoded) message for deduplication"""
+        return message.topic(), message.partition(), message.offset()
+
+    def poll(self, decode=True):
         message = self.consumer.poll(timeout=self.poll_timeout)
         if message is not None:
             self.last_message = message
+            if decode and not message.error():
+                self.consumer.decode(message)
         return message
 
     def get_partitions(self):
@@ -64,8 +354,12 @@ class KafkaWorker(BaseWorker):
         return self.consumer.position(self.get_partitions())
 
     def reset_consumer_offsets(self, offset):
-        self.consumer.assign([TopicPartition(tp.topic, tp.partition, offset)
-                              for tp in self.get_partitions()])
+        partitions = [TopicPartition(tp.topic, tp.partition, offset) for tp in self.get_partitions()]
+        if self.cooperative_rebalance:
+            for tp in partitions:
+                self.consumer.seek(tp)
+        else:
+            self.consumer.assign(partitions)
 
     def seek_to_timestamp(self, timestamp):
         timestamp_ms = dt_to_unix_ms(timestamp)
@@ -75,10 +369,58 @@ class KafkaWorker(BaseWorker):
         partitions = self.consumer.offsets_for_times(partitions)
         self.consumer.assign(partitions)
 
+    def on_assign(self, consumer, partitions):
+        """Assign the partitions, paused if flow control is holding back consumption"""
+        logger.info('partitions assigned: %s', partitions)
+        if self.cooperative_rebalance:
+            consumer.incremental_assign(partitions)
+        else:
+            consumer.assign(partitions)
+        if self.flow_paused and partitions:
+            # flow_control() resumes the whole assignment, these included
+            consumer.pause(partitions)
+
+    def on_revoke(self, consumer, partitions):
+        """Commit and forget the revoked partitions only; the client unassigns them afterwards"""
+        logger.info('partitions revoked: %s', partitions)
+        revoked = set((tp.topic, tp.partition) for tp in partitions)
+
+        if self.commit_on_complete and self.revoke_commit and not self.consumer_settings.get('enable.auto.commit'):
+            try:
+                if self.pool is not None:
+                    offsets = self.offsets.committable(partitions)
+                else:
+                    offsets = [tp for tp in consumer.position(partitions) if tp.offset >= 0]
+                if offsets:
+                    consumer.commit(offsets=offsets, asynchronous=False)
+            except KafkaException as exc:
+                logger.warning('commit on revoke failed: %s', exc)
+
+        for tp in revoked:
+            self.paused_retries.pop(tp, None)
+        if self.pool is not None:
+            self.offsets.revoke(partitions)
+            self.buffer = deque(item for item in self.buffer
+                                if (item[0].topic(), item[0].partition()) not in revoked)
+
     def handle(self):
-        message = self.poll()
+        if self.failure is not None:
+            raise self.failure
+
+        if self.paused_retries:
+            self.resume_retries()
+
+        if self.catch_up_lag and time.time() >= self.next_lag_check:
+            self.check_lag()
+
+        if self.pool is None and (self.batch_size or self.catching_up):
+            return self.handle_batch()
+
+        message = self.poll(decode=False)
 
         if message is None:
+            if self.commit_pending:
+                self.commit_handled()
             self.wait()
 
         elif message.error():
@@ -88,17 +430,339 @@ class KafkaWorker(BaseWorker):
             else:
                 raise KafkaException(message.error())
 
+        elif self.pool is not None:
+            self.dispatch(message)
+
         else:
-            self._consume(message)
+            self.handling = True
+            self.handle_message(message)
+            self.handling = False
+            self.commit_handled()
+
+        if self.pool is not None:
+            self.flow_control()
 
-            if self.commit_on_complete:
-                self.commit()
+        if self.retry_producer:
+            self.retry_producer.poll(0)
 
         self.done()
 
-    def commit(self):
-        if not self.consumer_settings.get('enable.auto.commit'):
-            self.consumer.commit(asynchronous=self.async_commit)
+    def handle_batch(self):
+        messages = self.consumer.consume(self.get_batch_size(), timeout=self.poll_timeout)
+        batch = []
+        message_ids = []
+        keys = []
+        self.handling = True
+
+        for message in messages:
+            if message.error():
+                if message.error().code() == KafkaError._PARTITION_EOF:
+                    self.partition_eof(message)
+                else:
+                    raise KafkaException(message.error())
+
+            elif (message.topic(), message.partition()) in self.paused_retries or self.delay_retry(message):
+                continue
+
+            else:
+                accepted, key = self.filter_message(message)
+                if not accepted:
+                    continue
+                message_id = self.get_message_id(message) if self.deduplicator else None
+                if message_id is None or not self.is_duplicate(message_id):
+                    batch.append(message)
+                    message_ids.append(message_id)
+                    keys.append(key)
+
+        if batch:
+            self.last_message = batch[-1]
+            if self.batch_size:
+                self.consume_batch(batch, keys)
+                self.count_handled(len(batch))
+                if self.deduplicator:
+                    for message_id in message_ids:
+                        self.deduplicator.add(message_id)
+            else:
+                # Catch-up fetches in batches, but messages are still handled, and retried, one by one
+                for message, message_id, key in zip(batch, message_ids, keys):
+                    self.process_message(message, message_id, key)
+        self.handling = False
+
+        if messages or self.commit_pending:
+            self.commit_handled()
+        if not messages:
+            self.wait()
+
+        if self.retry_producer:
+            self.retry_producer.poll(0)
+
+        self.done()
+
+    def get_batch_size(self):
+        if self.catching_up:
+            return max(self.batch_size or 0, self.catch_up_batch_size)
+        return self.batch_size
+
+    def consume_batch(self, messages, keys=None):
+        if self.batch_columnar:
+            self.consume_messages(self.consumer.decode_columns(messages))
+        else:
+            keys = keys or [UNDECODED] * len(messages)
+            self.consume_messages([MessageValue(self.consumer.decode(message, key))
+                                   for message, key in zip(messages, keys)])
+
+    def handle_message(self, message):
+        if self.delay_retry(message):
+            return
+        accepted, key = self.filter_message(message)
+        if not accepted:
+            return
+
+        message_id = self.get_message_id(message) if self.deduplicator else None
+        if message_id is None or not self.is_duplicate(message_id):
+            self.process_message(message, message_id, key)
+
+    def dispatch(self, message):
+        """Queue a message for the pool, after the checks that must happen in poll order"""
+        if self.delay_retry(message):
+            return
+
+        message_id = self.get_message_id(message) if self.deduplicator else None
+        self.offsets.add(message)
+        accepted, key = self.filter_message(message)
+        if not accepted or (message_id is not None and self.is_duplicate(message_id)):
+            self.offsets.done(message)
+        else:
+            self.buffer.append((message, message_id, key))
+
+    def filter_message(self, message):
+        """Check the raw message against the key and header filters, decoding only its key
+
+        Returns whether it is accepted and its key, UNDECODED unless the filters decoded
+        it, for process_message() to reuse.
+        """
+        if self.message_filter is None and self.accept is None:
+            return True, UNDECODED
+
+        key = raw_key = message.key()
+        if key is not None and (self.accept is not None or self.message_filter.needs_key):
+            try:
+                key = self.consumer.decode_key(message)
+            except SerializerError:
+                # Let process_message fail on it, or send it to the dead letter topic
+                return True, UNDECODED
+        headers = decode_headers(message.headers())
+
+        if ((self.message_filter is None or self.message_filter(key, headers)) and
+                (self.accept is None or self.accept(key, headers))):
+            return True, UNDECODED if key is raw_key else key
+        self.filtered_messages += 1
+        return False, UNDECODED
+
+    def is_duplicate(self, message_id):
+        if self.deduplicator.seen(message_id):
+            logger.debug('skipping duplicate message %r', message_id)
+            return True
+        return False
+
+    def flow_control(self):
+        while self.buffer and self.pool.free_count():
+            self.pool.spawn(self._process_in_pool, *self.buffer.popleft())
+
+        max_buffered = self.max_buffered or self.concurrency * 10
+        resume_buffered = self.resume_buffered or max_buffered // 2
+        buffered = len(self.buffer) + len(self.pool)
+
+        if not self.flow_paused and buffered >= max_buffered:
+            logger.info('%d messages buffered, pausing consumption', buffered)
+            self.consumer.pause(self.consumer.assignment())
+            self.flow_paused = True
+
+        elif self.flow_paused and buffered <= resume_buffered:
+            logger.info('%d messages buffered, resuming consumption', buffered)
+            self.consumer.resume([tp for tp in self.consumer.assignment()
+                                  if (tp.topic, tp.partition) not in self.paused_retries])
+            self.flow_paused = False
+
+    def _process_in_pool(self, message, message_id, key=UNDECODED):
+        try:
+            self.process_message(message, message_id, key)
+        except Exception as exc:
+            self.failure = exc
+            return
+        self.offsets.done(message)
+        self.commit_handled()
+
+    def process_message(self, message, message_id=None, key=UNDECODED):
+        original = (message.key(), message.value())
+        try:
+            self.consumer.decode(message, key)
+        except SerializerError as exc:
+            if not self.get_dead_letter_topic():
+                raise
+            self.retry_message(message, original, exc, retryable=False)
+        else:
+            try:
+                self._consume(message)
+            except self.retry_exceptions as exc:
+                if not self.retry_enabled():
+                    raise
+                logger.warning('failed to consume %s [%d] offset %d: %r',
+                               message.topic(), message.partition(), message.offset(), exc, exc_info=True)
+                sentry.captureException()
+                self.retry_message(message, original, exc)
+
+        if message_id is not None:
+            self.deduplicator.add(message_id)
+        self.count_handled()
+
+    def retry_message(self, message, original, exc, retryable=True):
+        """Forward the original bytes to the next retry topic, or the dead letter topic"""
+        headers = dict(message.headers() or ())
+        attempt = (_header_int(headers, RETRY_ATTEMPT_HEADER) or 0) + 1
+        retry_topics = self.get_retry_topics()
+
+        if retryable and attempt <= len(retry_topics):
+            topic, delay = retry_topics[attempt - 1]
+            headers[RETRY_NOT_BEFORE_HEADER] = str(_now_ms() + int(delay * 1000))
+        else:
+            topic = self.get_dead_letter_topic()
+            if topic is None:
+                raise exc
+            headers.pop(RETRY_NOT_BEFORE_HEADER, None)
+
+        headers[RETRY_ATTEMPT_HEADER] = str(attempt)
+        headers[RETRY_ERROR_HEADER] = repr(exc)[:1000]
+        headers.setdefault(ORIGINAL_TOPIC_HEADER, message.topic())
+        headers.setdefault(ORIGINAL_PARTITION_HEADER, str(message.partition()))
+        headers.setdefault(ORIGINAL_OFFSET_HEADER, str(message.offset()))
+
+        key, value = original
+        logger.info('sending %s [%d] offset %d to %s (attempt %d)',
+                    message.topic(), message.partition(), message.offset(), topic, attempt)
+        reports = []
+
+        def on_delivery(err, msg):
+            reports.append(err)
+
+        try:
+            self.retry_producer.produce(topic, value, key, headers=list(headers.items()), on_delivery=on_delivery)
+        except BufferError:
+            self.retry_producer.poll(1)
+            self.retry_producer.produce(topic, value, key, headers=list(headers.items()), on_delivery=on_delivery)
+        self.wait_forwarded(message, topic, reports)
+
+    def wait_forwarded(self, message, topic, reports):
+        """Wait for the delivery report of a forwarded message, raise if it wasn't delivered"""
+        deadline = time.time() + self.retry_delivery_timeout
+        while not reports and time.time() < deadline:
+            self.retry_producer.poll(0)
+            if not reports:
+                gevent.sleep(0.01)
+
+        error = reports[0] if reports else KafkaError(KafkaError._MSG_TIMED_OUT)
+        if error is not None:
+            logger.error('could not send %s [%d] offset %d to %s: %s',
+                         message.topic(), message.partition(), message.offset(), topic, error)
+            raise KafkaException(error)
+
+    def delay_retry(self, message):
+        """Pause a retry partition and rewind it if its next message is not due yet"""
+        if message.topic() not in self.retry_topic_names:
+            return False
+
+        not_before = _header_int(dict(message.headers() or ()), RETRY_NOT_BEFORE_HEADER)
+        if not_before is None or not_before <= _now_ms():
+            return False
+
+        partition = TopicPartition(message.topic(), message.partition(), message.offset())
+        self.consumer.pause([partition])
+        self.consumer.seek(partition)
+        self.paused_retries[(message.topic(), message.partition())] = not_before
+        return True
+
+    def resume_retries(self):
+        now = _now_ms()
+        due = [tp for tp, not_before in self.paused_retries.items() if not_before <= now]
+        if due:
+            if not self.flow_paused:
+                self.consumer.resume([TopicPartition(topic, partition) for topic, partition in due])
+            for tp in due:
+                del self.paused_retries[tp]
+
+    def get_commit_interval(self):
+        if self.catching_up:
+            return self.catch_up_commit_interval
+        return self.commit_interval
+
+    def commit_handled(self):
+        """Commit once messages are handled, at most once per commit interval"""
+        if not self.commit_on_complete:
+            return
+        now = time.time()
+        interval = self.get_commit_interval()
+        if interval and now - self.last_commit < interval:
+            self.commit_pending = True
+            return
+        self.commit()
+        self.last_commit = now
+        self.commit_pending = False
+
+    def get_lag(self):
+        """Messages behind the high watermarks of the assigned partitions, retry topics excluded"""
+        partitions = [tp for tp in self.consumer.assignment() if tp.topic not in self.retry_topic_names]
+        if not partitions:
+            return 0
+        lag = 0
+        for tp in self.consumer.position(partitions):
+            low, high = self.consumer.get_watermark_offsets(tp, cached=True)
+            if high >= 0 and tp.offset >= 0:
+                lag += max(high - tp.offset, 0)
+        return lag
+
+    def check_lag(self):
+        self.next_lag_check = time.time() + self.catch_up_check_interval
+        lag = self.get_lag()
+        self.metrics.gauge('consumer_lag').set(lag)
+
+        exit_lag = self.catch_up_exit_lag if self.catch_up_exit_lag is not None else self.catch_up_lag // 10
+        if not self.catching_up and lag >= self.catch_up_lag:
+            logger.info('%d messages behind, switching to catch-up mode', lag)
+            self.set_catching_up(True)
+        elif self.catching_up and lag <= exit_lag:
+            logger.info('%d messages behind, leaving catch-up mode', lag)
+            self.set_catching_up(False)
+
+    def set_catching_up(self, catching_up):
+        self.catching_up = catching_up
+        self.metrics.counter('catch_up_switches').inc()
+        if (self.catch_up_consumer_settings and self.static_membership and self.pool is None and
+                isinstance(self.consumer, DeferredAvroConsumer)):
+            self.rebuild_consumer()
+
+    def rebuild_consumer(self):
+        """Replace the consumer to apply new settings
+
+        Only a static member rejoins without a rebalance. With commit_on_complete the revoke
+        on close commits its offsets, otherwise the new consumer resumes from the last commit.
+        """
+        self.consumer.close()
+        self.paused_retries = {}
+        self.commit_pending = False
+        self.consumer = DeferredAvroConsumer(self.get_consumer_settings())
+        self.subscribe()
+
+    def commit(self, asynchronous=None):
+        if self.consumer_settings.get('enable.auto.commit'):
+            return
+        if asynchronous is None:
+            asynchronous = self.async_commit
+        if self.pool is not None:
+            offsets = self.offsets.committable()
+            if offsets:
+                self.consumer.commit(offsets=offsets, asynchronous=asynchronous)
+        else:
+            self.consumer.commit(asynchronous=asynchronous)
 
     def _consume(self, message):
         self.consume_message(MessageValue(message))
@@ -106,12 +770,17 @@ class KafkaWorker(BaseWorker):
     def consume_message(self, message):
         pass
 
+    def consume_messages(self, messages):
+        for message in messages:
+            self.consume_message(message)
+
     def partition_eof(self, message):
         pass
 
 
 class StartAtBeginningKafkaWorker(KafkaWorker):
     auto_offset_reset = 'earliest'
+    ephemeral_consumer = True
 
     def setup(self):
         super(StartAtBeginningKafkaWorker, self).setup()
@@ -120,12 +789,69 @@ class StartAtBeginningKafkaWorker(KafkaWorker):
 
 class StartAtEndKafkaWorker(KafkaWorker):
     auto_offset_reset = 'latest'
+    ephemeral_consumer = True
 
     def setup(self):
         super(StartAtEndKafkaWorker, self).setup()
         self.reset_consumer_offsets(OFFSET_END)
 
 
+class MultiTopicKafkaWorker(KafkaWorker):
+    """Consumes several topics through one consumer and routes each message to its topic's handler
+
+    topic_handlers maps each topic name to the name of the method handling its messages:
+
+        topic_handlers = {
+            'orders': 'consume_order',
+            'refunds': 'consume_refund',
+        }
+
+    Messages from retry topics go to the handler of the topic they originally came from.
+    Per topic, the worker counts consumed and failed messages, times the handlers and
+    tracks the last consumed offset of each partition in ``self.metrics``.
+    """
+    topic_handlers = {}
+
+    def setup(self):
+        self.handlers = dict((topic, getattr(self, name)) for topic, name in self.get_topic_handlers().items())
+        super(MultiTopicKafkaWorker, self).setup()
+
+    def get_topic_handlers(self):
+        return self.topic_handlers or utils.config_missing('topic handlers')
+
+    def get_topic_name(self):
+        return ','.join(sorted(self.get_topic_handlers()))
+
+    def get_subscribed_topics(self):
+        return sorted(self.get_topic_handlers()) + [topic for topic, delay in self.get_retry_topics()]
+
+    def get_handler_topic(self, message):
+        if message.topic() in self.retry_topic_names:
+            original_topic = dict(message.headers() or ()).get(ORIGINAL_TOPIC_HEADER)
+            if isinstance(original_topic, bytes):
+                original_topic = original_topic.decode('utf-8')
+            return original_topic
+        return message.topic()
+
+    def consume_message(self, message):
+        topic = self.get_handler_topic(message)
+        handler = self.handlers.get(topic)
+        if handler is None:
+            raise ValueError('No handler for topic {} at {} [{}] offset {}'
+                             .format(topic, message.topic(), message.partition(), message.offset()))
+
+        start = time.time()
+        try:
+            handler(message)
+        except Exception:
+            self.metrics.counter('messages_failed', topic=topic).inc()
+            raise
+        finally:
+            self.metrics.histogram('message_seconds', topic=topic).observe(time.time() - start)
+        self.metrics.counter('messages_consumed', topic=topic).inc()
+        self.metrics.gauge('offset', topic=message.topic(), partition=message.partition()).set(message.offset())
+
+
 class MessageValue(object):
     def __init__(self, message):
         self._message = message
@@ -147,6 +873,25 @@ class MessageValue(object):
         if ts_type != TIMESTAMP_NOT_AVAILABLE:
             return unix_to_dt(ts)
 
+    @property
+    def timestamp_ms(self):
+        ts_type, ts = self._message.timestamp()
+        if ts_type != TIMESTAMP_NOT_AVAILABLE:
+            return ts
+
+
+def _header_int(headers, name):
+    value = headers.get(name)
+    if value is not None:
+        try:
+            return int(value)
+        except ValueError:
+            pass
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
 
 # For compatibility
 KafkaConsumerWorker = KafkaConsumerWorker
@@ -0,0 +1,114 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+
+import six
+from cachetools import LRUCache
+
+from jangl_utils import logger
+
+__all__ = ['MessageDeduplicator', 'BloomFilter']
+
+
+class MessageDeduplicator(object):
+    """Remembers which messages have already been handled
+
+    Recent ids are kept in a bounded LRU. An optional ``BloomFilter`` remembers
+    older ids, and survives restarts when it is backed by a file.
+    """
+
+    def __init__(self, cache_size, bloom_filter=None):
+        self.cache = LRUCache(maxsize=cache_size)
+        self.bloom_filter = bloom_filter
+
+    def seen(self, message_id):
+        if message_id in self.cache:
+            return True
+        if self.bloom_filter is not None:
+            return _id_bytes(message_id) in self.bloom_filter
+        return False
+
+    def add(self, message_id):
+        self.cache[message_id] = True
+        if self.bloom_filter is not None:
+            self.bloom_filter.add(_id_bytes(message_id))
+
+    def close(self):
+        if self.bloom_filter is not None:
+            self.bloom_filter.close()
+
+
+class BloomFilter(object):
+    """Memory-mapped Bloom filter
+
+    The filter is cleared once it holds ``capacity`` items, so the false
+    positive rate never grows past ``error_rate``. A false positive means a
+    message is treated as a duplicate and skipped, so keep the rate low.
+    """
+    header = struct.Struct('>4sQIQ')
+    magic = b'JBF1'
+
+    def __init__(self, path, capacity=10000000, error_rate=1e-6):
+        self.path = path
+        self.capacity = capacity
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(float(self.num_bits) / capacity * math.log(2))))
+        size = self.header.size + (self.num_bits + 7) // 8
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, num_bits, num_hashes, self.count = self.header.unpack_from(self.mmap, 0)
+        if (magic, num_bits, num_hashes) != (self.magic, self.num_bits, self.num_hashes):
+            self.clear()
+
+    def __contains__(self, item):
+        for byte, mask in self._positions(item):
+            if not six.indexbytes(self.mmap, byte) & mask:
+                return False
+        return True
+
+    def add(self, item):
+        if self.count >= self.capacity:
+            logger.info('bloom filter %s is full, clearing', self.path)
+            self.clear()
+        for byte, mask in self._positions(item):
+            self.mmap[byte:byte + 1] = six.int2byte(six.indexbytes(self.mmap, byte) | mask)
+        self.count += 1
+        self._write_header()
+
+    def clear(self):
+        chunk = b'\0' * (1 << 20)
+        self.mmap.seek(0)
+        for start in range(0, len(self.mmap), len(chunk)):
+            self.mmap.write(chunk[:len(self.mmap) - start])
+        self.count = 0
+        self._write_header()
+
+    def close(self):
+        self.mmap.flush()
+        self.mmap.close()
+
+    def _write_header(self):
+        self.header.pack_into(self.mmap, 0, self.magic, self.num_bits, self.num_hashes, self.count)
+
+    def _positions(self, item):
+        # Double hashing: h1 + i * h2 gives num_hashes independent positions
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(item).digest())
+        for i in range(self.num_hashes):
+            bit = (h1 + i * h2) % self.num_bits
+            yield self.header.size + bit // 8, 1 << (bit % 8)
+
+
+def _id_bytes(message_id):
+    if isinstance(message_id, six.binary_type):
+        return message_id
+    return repr(message_id).encode('utf-8')
@@ -0,0 +1,62 @@
+import re
+
+import six
+
+__all__ = ['MessageFilter', 'compile_predicate', 'decode_headers']
+
+PATTERN_TYPE = type(re.compile(''))
+
+
+def compile_predicate(spec):
+    """Turn a filter spec into a function of one value
+
+    - None accepts everything
+    - A callable is used as is
+    - A compiled regex is matched against the value as text
+    - A string or number accepts only that value
+    - Any other iterable accepts the values it contains
+    """
+    if spec is None:
+        return None
+    if callable(spec):
+        return spec
+    if isinstance(spec, PATTERN_TYPE):
+        return lambda value: value is not None and spec.match(six.text_type(value)) is not None
+    if isinstance(spec, six.string_types + six.integer_types + (bytes, float)):
+        return lambda value: value == spec
+    return frozenset(spec).__contains__
+
+
+class MessageFilter(object):
+    """Predicates on the key and headers of a message, checked before its value is decoded
+
+    ``headers`` maps a header name to a spec for its value; a message without
+    the header is tested with None.
+    """
+
+    def __init__(self, keys=None, headers=None):
+        self.key_predicate = compile_predicate(keys)
+        self.header_predicates = [(name, compile_predicate(spec)) for name, spec in six.iteritems(headers or {})
+                                  if spec is not None]
+
+    @property
+    def needs_key(self):
+        return self.key_predicate is not None
+
+    def __call__(self, key, headers):
+        if self.key_predicate is not None and not self.key_predicate(key):
+            return False
+        for name, predicate in self.header_predicates:
+            if not predicate(headers.get(name)):
+                return False
+        return True
+
+
+def decode_headers(headers):
+    """Message headers as a dict of text values, the last value wins for repeated names"""
+    decoded = {}
+    for name, value in headers or ():
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        decoded[name] = value
+    return decoded
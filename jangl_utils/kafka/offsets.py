@@ -0,0 +1,65 @@
+from collections import deque
+
+from confluent_kafka import TopicPartition
+
+__all__ = ['OffsetTracker']
+
+
+class OffsetTracker(object):
+    """Tracks messages handled out of order so commits never skip unfinished work
+
+    The committable offset of a partition only advances past a message once it
+    and every earlier message of that partition are done.
+    """
+
+    def __init__(self):
+        self.partitions = {}
+
+    def __len__(self):
+        return sum(len(p.pending) for p in self.partitions.values())
+
+    def add(self, message):
+        key = (message.topic(), message.partition())
+        if key not in self.partitions:
+            self.partitions[key] = _PartitionOffsets()
+        self.partitions[key].pending.append(message.offset())
+
+    def done(self, message):
+        partition = self.partitions.get((message.topic(), message.partition()))
+        if partition is not None:
+            partition.done(message.offset())
+
+    def committable(self, partitions=None):
+        """Offsets that have advanced since the last call, ready to pass to ``Consumer.commit``
+
+        Limited to the given TopicPartitions, if any.
+        """
+        if partitions is not None:
+            partitions = set((tp.topic, tp.partition) for tp in partitions)
+        offsets = []
+        for (topic, partition), tracked in self.partitions.items():
+            if partitions is not None and (topic, partition) not in partitions:
+                continue
+            if tracked.next_offset is not None and tracked.next_offset != tracked.committed:
+                offsets.append(TopicPartition(topic, partition, tracked.next_offset))
+                tracked.committed = tracked.next_offset
+        return offsets
+
+    def revoke(self, partitions):
+        for tp in partitions:
+            self.partitions.pop((tp.topic, tp.partition), None)
+
+
+class _PartitionOffsets(object):
+    def __init__(self):
+        self.pending = deque()
+        self.finished = set()
+        self.next_offset = None
+        self.committed = None
+
+    def done(self, offset):
+        self.finished.add(offset)
+        while self.pending and self.pending[0] in self.finished:
+            offset = self.pending.popleft()
+            self.finished.discard(offset)
+            self.next_offset = offset + 1
@@ -105,7 +105,6 @@ class KafkaConsumerWorker(BaseWorker):
             consumer.commit(asynchronous=False)
         except KafkaException:
             pass
-        consumer.unassign()
 
     def on_commit(self, err, partitions):
         if err is None:
@@ -5,15 +5,17 @@ from datetime import datetime
 from django.utils.timezone import now as tz_now
 import gevent
 import signal
+import weakref
 from time import mktime
 from jangl_utils import logger, sentry
 from jangl_utils.backend_api import get_service_url
 from jangl_utils.kafka import settings
 from jangl_utils.kafka.schemas import Schema
-from jangl_utils.kafka.utils import generate_client_settings
+from jangl_utils.kafka.utils import flush_producer, generate_client_settings
+from jangl_utils.workers.shutdown import register_shutdown_hook
 
 
-__all__ = ['Producer', 'HashedPartitionProducer']
+__all__ = ['Producer', 'HashedPartitionProducer', 'flush_all_producers']
 
 
 class Producer(object):
@@ -41,6 +43,8 @@ class Producer(object):
         send_messages([(key1, message1), (key2, message2)])
         send_messages([message1, message2])
 
+    - encode_message: Encodes a message without sending it, returns (key, message)
+
     - get_timestamp: Will return a kafka-ready timestamp integer, defaults to now
     """
     topic_name = None
@@ -59,7 +63,8 @@ class Producer(object):
         self.topic_name = self.get_topic_name()
         self.key_schema = self.get_key_schema()
         self.value_schema = self.get_value_schema()
-        gevent.signal_handler(signal.SIGTERM, self._flush)
+        _producers.add(self)
+        _flush_on_sigterm()
 
     def get_producer_settings(self):
         broker_url = self.get_broker_url()
@@ -184,6 +189,21 @@ class Producer(object):
         """
         _async = kwargs.pop('_async', self._async)
 
+        encoded_key, encoded_message = self._encode(args, kwargs)
+        self._produce(encoded_message, key=encoded_key, **kwargs)
+
+        if not _async:
+            self._flush()
+
+    def encode_message(self, *args, **kwargs):
+        """ Encode a message with the topic's schemas without sending it
+
+        Accepts the same signatures as send_message and returns a (key, message) tuple of bytes.
+        The key is None if the topic does not have a key.
+        """
+        return self._encode(args, kwargs)
+
+    def _encode(self, args, kwargs):
         if self.has_key:
             if len(args) == 0:
                 key = kwargs.pop('key')
@@ -205,7 +225,7 @@ class Producer(object):
             logger.debug('key encoded w/ schema #{}: {}'.format(self.key_schema.schema_id, encoded_key))
             logger.debug('message encoded w/ schema #{}: {}'.format(self.value_schema.schema_id, encoded_message))
 
-            self._produce(encoded_message, key=encoded_key, **kwargs)
+            return encoded_key, encoded_message
 
         elif len(args) == 1:
             message = args[0]
@@ -215,14 +235,11 @@ class Producer(object):
             encoded_message = self.value_schema.encode_message(message)
             logger.debug('message encoded w/ schema #{}: {}'.format(self.value_schema.schema_id, encoded_message))
 
-            self._produce(encoded_message, **kwargs)
+            return None, encoded_message
 
         else:
             raise ValueError('Invalid message format')
 
-        if not _async:
-            self._flush()
-
     def _produce(self, value, key=None, **kwargs):
         try:
             self.producer.produce(self.topic_name, value, key, **kwargs)
@@ -239,3 +256,26 @@ class Producer(object):
 
 class HashedPartitionProducer(Producer):
     has_key = True
+
+
+_producers = weakref.WeakSet()
+
+
+@register_shutdown_hook
+def flush_all_producers(timeout=None):
+    """Flush every Producer of this process without blocking the gevent hub, returns the undelivered count"""
+    undelivered = 0
+    for producer in list(_producers):
+        remaining = flush_producer(producer.producer, timeout)
+        if remaining:
+            logger.warning('%d messages of %s were not delivered', remaining, producer.get_producer_name())
+            undelivered += remaining
+    return undelivered
+
+
+def _flush_on_sigterm():
+    global _sigterm_handler_installed
+    if not _sigterm_handler_installed:
+        gevent.signal_handler(signal.SIGTERM, gevent.spawn, flush_all_producers)
+        _sigterm_handler_installed = True
+_sigterm_handler_installed = False
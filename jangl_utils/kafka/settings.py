@@ -1,5 +1,7 @@
 from prettyconf import config
 
+from jangl_utils.settings import ENVIRONMENT
+
 try:
     from django.conf import settings as django_settings
 except ImportError:
@@ -16,4 +18,8 @@ SCHEMA_MICROSERVICE = getattr(django_settings, 'KAFKA_SCHEMA_MICROSERVICE',
 CONSUMER_BASE_NAME = getattr(django_settings, 'KAFKA_CONSUMER_BASE_NAME',
                              config('KAFKA_CONSUMER_BASE_NAME', default='JanglConsumer'))
 
-
+# Consumer group ids are built from these, so they must not change between restarts
+SERVICE_NAME = getattr(django_settings, 'KAFKA_SERVICE_NAME',
+                       config('KAFKA_SERVICE_NAME', default=CONSUMER_BASE_NAME))
+DEPLOYMENT_NAME = getattr(django_settings, 'KAFKA_DEPLOYMENT_NAME',
+                          config('KAFKA_DEPLOYMENT_NAME', default=ENVIRONMENT))
@@ -0,0 +1,266 @@
+import gzip
+import io
+import json
+import time
+
+import fastavro
+import gevent
+import six
+from confluent_kafka import KafkaError, TopicPartition, TIMESTAMP_CREATE_TIME, TIMESTAMP_NOT_AVAILABLE
+
+from jangl_utils.kafka.columnar import batch_from_records
+
+__all__ = ['FileMessage', 'FileMessageSource', 'NDJSONFileSource', 'AvroFileSource']
+
+
+class FileMessage(object):
+    """A recorded message with the same accessors as ``confluent_kafka.Message``"""
+
+    def __init__(self, topic, partition, offset, key=None, value=None, timestamp=None, headers=None, error=None):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._key = key
+        self._value = value
+        self._timestamp = timestamp
+        self._headers = headers
+        self._error = error
+
+    def error(self):
+        return self._error
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def key(self):
+        return self._key
+
+    def value(self):
+        return self._value
+
+    def headers(self):
+        return self._headers
+
+    def timestamp(self):
+        if self._timestamp is None:
+            return TIMESTAMP_NOT_AVAILABLE, 0
+        return TIMESTAMP_CREATE_TIME, self._timestamp
+
+    def set_key(self, key):
+        self._key = key
+
+    def set_value(self, value):
+        self._value = value
+
+
+class FileMessageSource(object):
+    """Replays recorded messages through the consumer interface used by ``KafkaWorker``
+
+    Records are streamed one at a time, so memory use does not depend on the
+    size of the capture. With ``envelope=True`` each record is a dict of
+    ``topic``, ``partition``, ``offset``, ``timestamp`` (unix ms), ``key``,
+    ``value`` and ``headers``; otherwise the whole record is the message value.
+
+    Replay rate:
+    - rate: Deliver a fixed number of messages per second
+    - speed: Keep the original spacing of the timestamps, sped up by this factor
+    - Neither: Deliver messages as fast as the worker can take them
+
+    Once every file is read a partition EOF event is returned. Afterwards the
+    source starts over if ``loop`` is set, or stops the worker if ``stop_at_end`` is set.
+    """
+
+    def __init__(self, paths, topic=None, envelope=True, timestamp_field=None,
+                 rate=None, speed=None, loop=False, stop_at_end=False):
+        if isinstance(paths, six.string_types):
+            paths = [paths]
+        self.paths = paths
+        self.topic = topic
+        self.envelope = envelope
+        self.timestamp_field = timestamp_field
+        self.rate = rate
+        self.speed = speed
+        self.loop = loop
+        self.stop_at_end = stop_at_end
+        self.positions = {}
+        self._offset = 0
+        self._records = None
+        self._next = None
+        self._at_end = False
+        self._eof_sent = False
+        self._restart_schedule()
+
+    def read_records(self, fo):
+        raise NotImplementedError
+
+    def open(self, path):
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rb')
+        return io.open(path, 'rb')
+
+    def subscribe(self, topics, **kwargs):
+        if self.topic is None:
+            self.topic = topics[0]
+
+    def poll(self, timeout=None):
+        message = self._peek()
+        if message is None:
+            return self._end_of_data(timeout)
+
+        delay = self._due(message) - time.time()
+        if delay > 0:
+            if timeout is not None and 0 <= timeout < delay:
+                gevent.sleep(timeout)
+                return None
+            gevent.sleep(delay)
+
+        self._next = None
+        self._sent += 1
+        self.positions[message.partition()] = message.offset() + 1
+        return message
+
+    def consume(self, num_messages=1, timeout=-1):
+        deadline = time.time() + timeout if timeout is not None and timeout >= 0 else None
+        messages = []
+        while len(messages) < num_messages:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            message = self.poll(remaining)
+            if message is None:
+                break
+            messages.append(message)
+            if message.error():
+                break
+        return messages
+
+    def decode(self, message, key=None):
+        return message
+
+    def decode_key(self, message):
+        return message.key()
+
+    def decode_columns(self, messages):
+        """Turn a batch of recorded messages into a ``ColumnBatch``, for batch_columnar"""
+        return batch_from_records(messages)
+
+    def assignment(self):
+        return [TopicPartition(self.topic, partition) for partition in sorted(self.positions)]
+
+    def position(self, partitions):
+        return [TopicPartition(tp.topic, tp.partition, self.positions.get(tp.partition, 0)) for tp in partitions]
+
+    def commit(self, *args, **kwargs):
+        pass
+
+    def pause(self, partitions):
+        pass
+
+    def resume(self, partitions):
+        pass
+
+    def seek(self, partition):
+        pass
+
+    def close(self):
+        self._records = None
+
+    def _iter_messages(self):
+        for path in self.paths:
+            with self.open(path) as fo:
+                for record in self.read_records(fo):
+                    yield self._to_message(record)
+
+    def _to_message(self, record):
+        offset = self._offset
+        self._offset += 1
+
+        if not self.envelope:
+            timestamp = record.get(self.timestamp_field) if self.timestamp_field else None
+            return FileMessage(self.topic, 0, offset, value=record, timestamp=timestamp)
+
+        headers = record.get('headers')
+        if isinstance(headers, dict):
+            headers = list(headers.items())
+        return FileMessage(
+            record.get('topic') or self.topic,
+            record.get('partition') or 0,
+            record['offset'] if record.get('offset') is not None else offset,
+            key=record.get('key'),
+            value=record.get('value'),
+            timestamp=record.get('timestamp'),
+            headers=headers,
+        )
+
+    def _peek(self):
+        if self._next is None and not self._at_end:
+            if self._records is None:
+                self._records = self._iter_messages()
+            try:
+                self._next = next(self._records)
+            except StopIteration:
+                self._records = None
+                self._at_end = True
+        return self._next
+
+    def _end_of_data(self, timeout):
+        if not self._eof_sent:
+            self._eof_sent = True
+            return FileMessage(self.topic, 0, self._offset, error=KafkaError(KafkaError._PARTITION_EOF))
+        if self.loop:
+            self._at_end = False
+            self._eof_sent = False
+            self._restart_schedule()
+        elif self.stop_at_end:
+            raise gevent.GreenletExit
+        elif timeout:
+            gevent.sleep(timeout if timeout > 0 else 1)
+        return None
+
+    def _restart_schedule(self):
+        self._started = None
+        self._first_timestamp = None
+        self._sent = 0
+
+    def _due(self, message):
+        if self._started is None:
+            self._started = time.time()
+        if self.rate:
+            return self._started + self._sent / float(self.rate)
+        if self.speed:
+            ts_type, timestamp = message.timestamp()
+            if ts_type == TIMESTAMP_NOT_AVAILABLE:
+                return 0
+            if self._first_timestamp is None:
+                self._first_timestamp = timestamp
+            return self._started + (timestamp - self._first_timestamp) / 1000.0 / self.speed
+        return 0
+
+
+class NDJSONFileSource(FileMessageSource):
+    """Replays newline-delimited JSON captures, optionally gzipped"""
+
+    def read_records(self, fo):
+        for line in fo:
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode('utf-8'))
+
+
+class AvroFileSource(FileMessageSource):
+    """Replays Avro object container files, optionally gzipped
+
+    Unlike the other sources each record is the message value by default, pass
+    ``envelope=True`` for files of recorded envelopes.
+    """
+
+    def __init__(self, paths, topic=None, envelope=False, **kwargs):
+        super(AvroFileSource, self).__init__(paths, topic=topic, envelope=envelope, **kwargs)
+
+    def read_records(self, fo):
+        for record in fastavro.reader(fo):
+            yield record
@@ -0,0 +1,113 @@
+import os
+import sqlite3
+
+from six.moves import cPickle as pickle
+
+__all__ = ['MemoryStore', 'SqliteStore']
+
+
+class MemoryStore(object):
+    """Key/value store held in a dict
+
+    A checkpoint pickles the data together with the consumer offsets it
+    reflects, and restore() loads them back.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {}
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def items(self):
+        return self.data.items()
+
+    def checkpoint(self, offsets):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fo:
+            pickle.dump((offsets, self.data), fo, pickle.HIGHEST_PROTOCOL)
+            fo.flush()
+            os.fsync(fo.fileno())
+        os.rename(tmp_path, self.path)
+
+    def restore(self):
+        """Load the last checkpoint and return its offsets"""
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'rb') as fo:
+            offsets, self.data = pickle.load(fo)
+        return offsets
+
+    def close(self):
+        pass
+
+
+class SqliteStore(object):
+    """Key/value store in a memory-mapped sqlite database
+
+    Writes stay in an open transaction until the next checkpoint, which commits
+    them together with the consumer offsets, so the two never disagree.
+    """
+    mmap_size = 256 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA mmap_size={:d}'.format(self.mmap_size))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS kv (key PRIMARY KEY, value BLOB)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS offsets '
+                                '(topic TEXT, partition INTEGER, offset INTEGER, PRIMARY KEY (topic, partition))')
+        self.connection.commit()
+
+    def __contains__(self, key):
+        return self.connection.execute('SELECT 1 FROM kv WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM kv').fetchone()[0]
+
+    def get(self, key, default=None):
+        row = self.connection.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(bytes(row[0]))
+
+    def set(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)',
+                                (key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+
+    def delete(self, key):
+        self.connection.execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def items(self):
+        for key, value in self.connection.execute('SELECT key, value FROM kv'):
+            yield key, pickle.loads(bytes(value))
+
+    def checkpoint(self, offsets):
+        self.connection.executemany('INSERT OR REPLACE INTO offsets (topic, partition, offset) VALUES (?, ?, ?)',
+                                    [(topic, partition, offset) for (topic, partition), offset in offsets.items()])
+        self.connection.commit()
+
+    def restore(self):
+        """Return the offsets of the last checkpoint"""
+        rows = self.connection.execute('SELECT topic, partition, offset FROM offsets')
+        return dict(((topic, partition), offset) for topic, partition, offset in rows)
+
+    def close(self):
+        self.connection.rollback()
+        self.connection.close()
@@ -0,0 +1,152 @@
+import time
+
+from confluent_kafka import KafkaError, KafkaException, Producer as ConfluentProducer, TopicPartition
+
+from jangl_utils import logger
+from jangl_utils.kafka import utils
+from jangl_utils.kafka.consumers import KafkaWorker
+from jangl_utils.kafka.registry import get_producer
+
+__all__ = ['StreamProcessor']
+
+
+class StreamProcessor(KafkaWorker):
+    """Consume-transform-produce worker with exactly-once results
+
+    Input messages are handled in batches. Each batch runs inside one Kafka
+    transaction: everything sent with ``send`` and the consumer offsets of the
+    batch are committed together, or not at all.
+
+    Implement consume_message(message) and call self.send(producer_name, ...) for
+    every output. producer_name is a registered Producer; its topic and schemas
+    are used to encode the output, which is then sent through the transactional
+    producer. send accepts the same arguments as Producer.send_message.
+
+    Optional:
+    - batch_size: Maximum number of input messages per transaction
+    - batch_timeout: Maximum seconds to collect a batch before committing it
+    - transaction_timeout_ms: Broker-side timeout for an open transaction
+    - transactional_producer_settings: A dict of kafka settings to overwrite the defaults
+
+    Retry and dead letter topics are written inside the batch transaction. Message
+    deduplication is not needed, and would skip messages of aborted batches on replay.
+    """
+    batch_size = 500
+    batch_timeout = 1.0
+    transaction_timeout_ms = 60000
+    transactional_producer_settings = {}
+    transactional_producer = None
+    dedupe_cache_size = None
+
+    def setup(self):
+        self.batch = []
+        self.batch_started = None
+        self.transactional_producer = ConfluentProducer(self.get_transactional_producer_settings())
+        self.transactional_producer.init_transactions()
+        super(StreamProcessor, self).setup()
+
+    def teardown(self):
+        self.batch = []
+        super(StreamProcessor, self).teardown()
+
+    def get_consumer_settings(self):
+        consumer_settings = super(StreamProcessor, self).get_consumer_settings()
+        consumer_settings.setdefault('isolation.level', 'read_committed')
+        return consumer_settings
+
+    def get_retry_producer(self):
+        # Failed messages are forwarded inside the same transaction as their batch
+        return self.transactional_producer
+
+    def wait_forwarded(self, message, topic, reports):
+        """Forwards are delivered with the batch transaction, or aborted with it"""
+
+    def get_transactional_id(self):
+        return '{}.{}'.format(self.get_consumer_name(), self.get_worker_identity())
+
+    def get_transactional_producer_settings(self):
+        default_settings = {
+            'bootstrap.servers': utils.get_broker_url(),
+            'api.version.request': True,
+            'client.id': 'JanglStreamProcessor',
+            'transactional.id': self.get_transactional_id(),
+            'transaction.timeout.ms': self.transaction_timeout_ms,
+            'enable.idempotence': True,
+            'default.topic.config': {},
+        }
+        return utils.generate_client_settings(default_settings, self.transactional_producer_settings)
+
+    def handle(self):
+        if self.paused_retries:
+            self.resume_retries()
+
+        messages = self.consumer.consume(self.batch_size - len(self.batch), timeout=0)
+
+        for message in messages:
+            if not message.error():
+                self.batch.append(message)
+            elif message.error().code() == KafkaError._PARTITION_EOF:
+                self.partition_eof(message)
+            else:
+                raise KafkaException(message.error())
+
+        if self.batch:
+            if self.batch_started is None:
+                self.batch_started = time.time()
+            if len(self.batch) >= self.batch_size or time.time() - self.batch_started >= self.batch_timeout:
+                self.process_batch()
+
+        if not messages:
+            self.wait()
+
+        self.transactional_producer.poll(0)
+        self.done()
+
+    def process_batch(self):
+        batch, self.batch, self.batch_started = self.batch, [], None
+        self.last_message = batch[-1]
+        producer = self.transactional_producer
+
+        producer.begin_transaction()
+        try:
+            positions = {}
+            for message in batch:
+                tp = (message.topic(), message.partition())
+                if tp in self.paused_retries:
+                    # A retry partition was rewound earlier in this batch
+                    continue
+                self.handle_message(message)
+                if tp not in self.paused_retries:
+                    positions[tp] = message.offset() + 1
+
+            offsets = [TopicPartition(topic, partition, offset)
+                       for (topic, partition), offset in positions.items()]
+            if offsets:
+                producer.send_offsets_to_transaction(offsets, self.consumer.consumer_group_metadata())
+            producer.commit_transaction()
+        except Exception:
+            logger.warning('aborting transaction for %d messages', len(batch))
+            producer.abort_transaction()
+            raise
+
+    def send(self, producer_name, *args, **kwargs):
+        produce_kwargs = dict((name, kwargs.pop(name)) for name in ('partition', 'headers', 'timestamp')
+                              if name in kwargs)
+        producer = get_producer(producer_name)
+        key, value = producer.encode_message(*args, **kwargs)
+        try:
+            self.transactional_producer.produce(producer.topic_name, value, key, **produce_kwargs)
+        except BufferError:
+            self.transactional_producer.poll(1)
+            self.transactional_producer.produce(producer.topic_name, value, key, **produce_kwargs)
+
+    def commit(self, asynchronous=None):
+        """Offsets are committed with each transaction"""
+
+    def on_revoke(self, consumer, partitions):
+        logger.info('partitions revoked: %s', partitions)
+        revoked = set((tp.topic, tp.partition) for tp in partitions)
+        # Nothing from the pending batch has been produced yet, the new owner will handle it
+        self.batch = [message for message in self.batch if (message.topic(), message.partition()) not in revoked]
+        for tp in revoked:
+            self.paused_retries.pop(tp, None)
@@ -0,0 +1,139 @@
+import time
+
+from confluent_kafka import TopicPartition, OFFSET_BEGINNING
+from gevent.event import Event
+
+from jangl_utils import logger
+from jangl_utils.kafka.consumers import KafkaWorker
+from jangl_utils.kafka.stores import MemoryStore, SqliteStore
+
+__all__ = ['KafkaTable', 'MemoryStore', 'SqliteStore']
+
+
+class KafkaTable(KafkaWorker):
+    """Latest value per key of a compacted topic, kept in a local store
+
+    Every instance reads all partitions of the topic. The store is checkpointed
+    with the offsets it reflects every ``checkpoint_interval`` seconds, and on
+    start the table restores the checkpoint and only reads the tail of the topic.
+    Tombstones (null values) delete their key.
+
+    ``caught_up`` is set once the consumer position has reached the high watermarks
+    seen on start, which also counts transaction markers and filtered messages; use
+    ``wait_caught_up()`` before serving reads. Workers with the table in their
+    ``depends_on`` start once it has caught up.
+
+    Optional:
+    - store_class: MemoryStore (pickled snapshots) or SqliteStore
+    - store_path: Where the checkpoint or database lives, MemoryStore keeps no snapshot without it
+    - get_table_key / get_table_value: Override to change what is stored for a message
+    """
+    store_class = MemoryStore
+    store_path = None
+    checkpoint_interval = 60
+    watermark_timeout = 10
+    ready_after_setup = False
+    store = None
+
+    def __init__(self, *args, **kwargs):
+        super(KafkaTable, self).__init__(*args, **kwargs)
+        self.caught_up = Event()
+
+    def setup(self):
+        self.store = self.get_store()
+        self.positions = self.store.restore()
+        self.lagging = {}
+        self.last_checkpoint = time.time()
+        super(KafkaTable, self).setup()
+
+    def teardown(self):
+        if self.store is not None:
+            self.checkpoint()
+            self.store.close()
+        super(KafkaTable, self).teardown()
+
+    def get_store(self):
+        return self.store_class(self.store_path)
+
+    def subscribe(self):
+        topic = self.get_topic_name()
+        metadata = self.consumer.list_topics(topic, timeout=self.watermark_timeout)
+        partitions = [TopicPartition(topic, partition, self.positions.get((topic, partition), OFFSET_BEGINNING))
+                      for partition in sorted(metadata.topics[topic].partitions)]
+        logger.info('table %s restored %d keys, reading from %s', topic, len(self.store), partitions)
+
+        for tp in partitions:
+            low, high = self.consumer.get_watermark_offsets(tp, timeout=self.watermark_timeout)
+            if high > max(low, tp.offset):
+                self.lagging[(tp.topic, tp.partition)] = high
+        self.consumer.assign(partitions)
+        self.check_caught_up()
+
+    def handle(self):
+        super(KafkaTable, self).handle()
+        if self.lagging:
+            self.check_positions()
+        if time.time() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.store.checkpoint(dict(self.positions))
+        self.last_checkpoint = time.time()
+
+    def consume_message(self, message):
+        key = self.get_table_key(message)
+        if message.value() is None:
+            self.store.delete(key)
+        else:
+            self.store.set(key, self.get_table_value(message))
+
+        self.positions[(message.topic(), message.partition())] = message.offset() + 1
+
+    def check_positions(self):
+        if self.pool is not None and (self.buffer or len(self.pool)):
+            # The position is ahead of the messages still being handled
+            return
+        partitions = [TopicPartition(topic, partition) for topic, partition in self.lagging]
+        for tp in self.consumer.position(partitions):
+            if tp.offset >= self.lagging[(tp.topic, tp.partition)]:
+                del self.lagging[(tp.topic, tp.partition)]
+        self.check_caught_up()
+
+    def check_caught_up(self):
+        if not self.lagging and not self.caught_up.is_set():
+            logger.info('table %s caught up with %d keys', self.get_topic_name(), len(self.store))
+            self.caught_up.set()
+            self.mark_ready()
+
+    def wait_caught_up(self, timeout=None):
+        return self.caught_up.wait(timeout)
+
+    def get_table_key(self, message):
+        return message.key()
+
+    def get_table_value(self, message):
+        return message.value()
+
+    def commit(self, asynchronous=None):
+        """Offsets are kept with the store checkpoints"""
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __getitem__(self, key):
+        value = self.store.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        return len(self.store)
+
+    def get(self, key, default=None):
+        return self.store.get(key, default)
+
+    def items(self):
+        return self.store.items()
+
+
+_missing = object()
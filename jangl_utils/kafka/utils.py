@@ -1,3 +1,6 @@
+import time
+
+import gevent
 import six
 
 from jangl_utils import logger
@@ -19,6 +22,23 @@ def generate_client_settings(initial_settings, user_settings):
     return settings
 
 
+def flush_producer(producer, timeout=None):
+    """Flush a confluent producer without blocking the gevent hub
+
+    Returns the number of messages still queued once ``timeout`` seconds have passed.
+    """
+    deadline = time.time() + timeout if timeout is not None else None
+    while True:
+        remaining = producer.flush(0)
+        if not remaining or (deadline is not None and time.time() >= deadline):
+            return remaining
+        gevent.sleep(0.05)
+
+
+def generate_consumer_name(worker_name):
+    return '{}.{}.{}'.format(settings.SERVICE_NAME, settings.DEPLOYMENT_NAME, worker_name)
+
+
 def generate_random_consumer_name():
     return '{}-{}'.format(settings.CONSUMER_BASE_NAME, get_unique_id())
 
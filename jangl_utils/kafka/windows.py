@@ -0,0 +1,251 @@
+import time
+from array import array
+
+from confluent_kafka import KafkaException, TopicPartition
+
+from jangl_utils import logger
+from jangl_utils.kafka import utils
+from jangl_utils.kafka.consumers import KafkaWorker
+from jangl_utils.kafka.registry import get_producer
+from jangl_utils.kafka.stores import MemoryStore
+from jangl_utils.workers import shutdown
+
+__all__ = ['TumblingWindows', 'HoppingWindows', 'WindowedKafkaWorker']
+
+
+class TumblingWindows(object):
+    """Back-to-back windows of ``size`` seconds"""
+
+    def __init__(self, size):
+        self.size_ms = int(size * 1000)
+        self.advance_ms = self.size_ms
+
+    def window_starts(self, timestamp_ms):
+        start = timestamp_ms - timestamp_ms % self.advance_ms
+        while start > timestamp_ms - self.size_ms:
+            yield start
+            start -= self.advance_ms
+
+
+class HoppingWindows(TumblingWindows):
+    """Overlapping windows of ``size`` seconds, starting every ``advance`` seconds"""
+
+    def __init__(self, size, advance):
+        super(HoppingWindows, self).__init__(size)
+        self.advance_ms = int(advance * 1000)
+
+
+class WindowState(object):
+    """Counters of one window, stored in a flat array with one row per key
+
+    Each row holds the count followed by one sum per aggregated field.
+    """
+
+    def __init__(self, start, end, width):
+        self.start = start
+        self.end = end
+        self.width = width
+        self.index = {}
+        self.counters = array('d')
+
+    def add(self, key, values):
+        row = self.index.get(key)
+        if row is None:
+            row = self.index[key] = len(self.index)
+            self.counters.extend([0.0] * self.width)
+        base = row * self.width
+        self.counters[base] += 1
+        for i, value in enumerate(values, base + 1):
+            self.counters[i] += value
+
+    def results(self):
+        for key, row in self.index.items():
+            yield key, self.counters[row * self.width:(row + 1) * self.width]
+
+
+class PartitionWindows(object):
+    # Wall clock time of the last message, in milliseconds
+    updated_ms = None
+
+    def __init__(self):
+        self.stream_time = 0
+        self.windows = {}
+
+
+class WindowedKafkaWorker(KafkaWorker):
+    """Counts and sums messages per key in time windows
+
+    Messages are assigned to windows by their Kafka timestamp. A window closes
+    once the stream time of its partition passes its end plus ``grace_period``
+    seconds; it is then emitted through the registered producer named in
+    ``output_producer``. Messages arriving after their windows closed are dropped.
+    A partition without messages for ``idle_timeout`` seconds has its stream time
+    advanced by the wall clock, so its last windows close too.
+
+    Open windows are kept per partition and checkpointed with their offsets to
+    ``state_path`` every ``checkpoint_interval`` seconds, so a restarted worker
+    resumes where the checkpoint left off. The output producer is flushed first, and
+    the checkpoint skipped if that fails, so no offset is committed past windows that
+    weren't delivered. The state is local: when a partition
+    moves to another host its open windows start over there, so pair this with
+    static membership.
+
+    Override:
+    - get_window_key(message): What to group by, e.g. message['buyer_id']
+    - get_window_values(message): The numbers to sum, defaults to ``aggregate_fields`` of the value
+    - get_window_output(key, start, end, counters): The message sent for a closed window
+    """
+    windows = TumblingWindows(60)
+    grace_period = 10
+    aggregate_fields = ()
+    output_producer = None
+    state_path = None
+    checkpoint_interval = 60
+    checkpoint_flush_timeout = 30
+    idle_timeout = 30
+    commit_on_complete = False
+    store = None
+
+    def setup(self):
+        self.store = MemoryStore(self.state_path)
+        self.positions = self.store.restore()
+        self.partition_windows = self.store.get('partitions', {})
+        self.late_messages = 0
+        self.last_checkpoint = time.time()
+        self.next_idle_check = time.time()
+        now_ms = int(time.time() * 1000)
+        for state in self.partition_windows.values():
+            state.updated_ms = now_ms
+        super(WindowedKafkaWorker, self).setup()
+
+    def teardown(self):
+        if self.store is not None and self.consumer is not None:
+            self.checkpoint(shutdown.remaining(self.drain_timeout))
+        super(WindowedKafkaWorker, self).teardown()
+
+    def on_assign(self, consumer, partitions):
+        for tp in partitions:
+            offset = self.positions.get((tp.topic, tp.partition))
+            if offset is not None and (tp.topic, tp.partition) in self.partition_windows:
+                tp.offset = offset
+        super(WindowedKafkaWorker, self).on_assign(consumer, partitions)
+
+    def on_revoke(self, consumer, partitions):
+        self.checkpoint()
+        super(WindowedKafkaWorker, self).on_revoke(consumer, partitions)
+        for tp in partitions:
+            self.partition_windows.pop((tp.topic, tp.partition), None)
+            self.positions.pop((tp.topic, tp.partition), None)
+
+    def handle(self):
+        super(WindowedKafkaWorker, self).handle()
+        now = time.time()
+        if self.idle_timeout and now >= self.next_idle_check:
+            self.advance_idle_partitions()
+            self.next_idle_check = now + 1
+        if now - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def advance_idle_partitions(self):
+        """Move the stream time of partitions idle for idle_timeout along with the wall clock"""
+        now_ms = int(time.time() * 1000)
+        idle_ms = int(self.idle_timeout * 1000)
+        for state in self.partition_windows.values():
+            if state.updated_ms is None:
+                state.updated_ms = now_ms
+            elif state.windows and now_ms - state.updated_ms >= idle_ms:
+                state.stream_time += now_ms - state.updated_ms
+                state.updated_ms = now_ms
+                self.close_windows(state)
+
+    def consume_message(self, message):
+        tp = (message.topic(), message.partition())
+        state = self.partition_windows.get(tp)
+        if state is None:
+            state = self.partition_windows[tp] = PartitionWindows()
+
+        timestamp = message.timestamp_ms
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        closed_before = state.stream_time - int(self.grace_period * 1000)
+
+        key = self.get_window_key(message)
+        values = self.get_window_values(message)
+        accepted = False
+        for start in self.windows.window_starts(timestamp):
+            end = start + self.windows.size_ms
+            if end <= closed_before:
+                continue
+            window = state.windows.get(start)
+            if window is None:
+                window = state.windows[start] = WindowState(start, end, len(values) + 1)
+            window.add(key, values)
+            accepted = True
+
+        if not accepted:
+            self.late_messages += 1
+            logger.debug('dropping late message at %d on %s', timestamp, tp)
+
+        self.positions[tp] = message.offset() + 1
+        state.updated_ms = int(time.time() * 1000)
+        if timestamp > state.stream_time:
+            state.stream_time = timestamp
+            self.close_windows(state)
+
+    def close_windows(self, state):
+        closed_before = state.stream_time - int(self.grace_period * 1000)
+        for start in sorted(start for start, window in state.windows.items() if window.end <= closed_before):
+            window = state.windows.pop(start)
+            for key, counters in window.results():
+                self.emit_window(key, window.start, window.end, counters)
+
+    def emit_window(self, key, start, end, counters):
+        producer = get_producer(self.output_producer)
+        output = self.get_window_output(key, start, end, counters)
+        if producer.has_key:
+            producer.send_message(key, output)
+        else:
+            producer.send_message(output)
+
+    def get_window_key(self, message):
+        return message.key()
+
+    def get_window_values(self, message):
+        return [message[field] or 0 for field in self.aggregate_fields]
+
+    def get_window_output(self, key, start, end, counters):
+        output = {
+            'key': key,
+            'window_start': start,
+            'window_end': end,
+            'count': int(counters[0]),
+        }
+        for field, total in zip(self.aggregate_fields, counters[1:]):
+            output[field] = total
+        return output
+
+    def checkpoint(self, flush_timeout=None):
+        if self.output_producer:
+            producer = get_producer(self.output_producer)
+            timeout = self.checkpoint_flush_timeout if flush_timeout is None else flush_timeout
+            undelivered = utils.flush_producer(producer.producer, timeout)
+            if undelivered:
+                logger.warning('not checkpointing, %d window results were not delivered', undelivered)
+                return
+
+        self.store.set('partitions', self.partition_windows)
+        self.store.checkpoint(dict(self.positions))
+        self.last_checkpoint = time.time()
+
+        offsets = self.get_checkpoint_offsets()
+        if offsets and not self.consumer_settings.get('enable.auto.commit'):
+            try:
+                self.consumer.commit(offsets=offsets, asynchronous=True)
+            except KafkaException as exc:
+                logger.warning('commit after checkpoint failed: %s', exc)
+
+    def get_checkpoint_offsets(self):
+        return [TopicPartition(topic, partition, offset) for (topic, partition), offset in self.positions.items()]
+
+    def commit(self, asynchronous=None):
+        """Offsets are committed with each checkpoint"""
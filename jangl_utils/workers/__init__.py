@@ -1,3 +1,4 @@
 default_app_config = 'jangl_utils.workers.apps.WorkersConfig'
 
 from jangl_utils.workers.base import BaseWorker, worker_registry, register_worker
+from jangl_utils.workers.threads import run_in_threadpool, in_threadpool
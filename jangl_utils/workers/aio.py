@@ -0,0 +1,143 @@
+"""asyncio counterparts of BaseWorker and the worker registry (Python 3 only)"""
+import asyncio
+import inspect
+import signal
+from collections import Counter
+
+from jangl_utils import logger, sentry
+from jangl_utils.workers import settings
+from jangl_utils.workers.metrics import Metrics
+
+__all__ = ['AsyncWorker', 'AsyncWorkerRegistry', 'async_worker_registry', 'register_async_worker', 'run_workers']
+
+
+class AsyncWorker(object):
+    """Worker with the BaseWorker lifecycle, run as an asyncio task
+
+    setup, handle and teardown are coroutines. ``ready`` may be a plain or async
+    callable; setup waits until it returns True. A failing worker is torn down and
+    set up again, up to ``max_attempts`` times.
+    """
+    sleep_time = 0.1
+    max_attempts = 3
+    worker_name = None
+    ready = None
+
+    def __init__(self, worker_index=0, **kwargs):
+        self.worker_index = worker_index
+        self.kwargs = kwargs
+        self.attempt = 0
+        self.stopping = False
+        self.logger = logger
+        self.metrics = Metrics()
+
+    def __repr__(self):
+        return '<{} - Attempt: {}>'.format(self.__class__.__name__, self.attempt)
+
+    async def run(self):
+        while not self.stopping:
+            self.attempt += 1
+            logger.info('run: attempt %d - %r', self.attempt, self)
+            try:
+                await self.wait_ready()
+                await self.setup()
+                while not self.stopping:
+                    await self.handle()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.error('Unrecoverable error %r: %r', self, exc, exc_info=True)
+                sentry.captureException()
+                if self.attempt >= self.max_attempts:
+                    raise
+            else:
+                return
+            finally:
+                logger.warning('tearing down %r', self)
+                with sentry.capture_on_error(raise_error=False):
+                    await self.teardown()
+            await self.wait()
+
+    async def wait_ready(self):
+        if self.ready is None:
+            return
+        logger.info('{} setup waiting'.format(self.__class__.__name__))
+        while not await _maybe_await(self.ready()):
+            await self.wait()
+        logger.info('{} setup ready'.format(self.__class__.__name__))
+
+    def stop(self):
+        """Finish the current handle() and tear down"""
+        self.stopping = True
+
+    def get_worker_identity(self):
+        """A name for this worker that stays the same across restarts and deploys"""
+        return '{}.{}.{}'.format(settings.WORKER_IDENTITY, self.worker_name or self.__class__.__name__,
+                                 self.worker_index)
+
+    async def wait(self):
+        await asyncio.sleep(self.sleep_time)
+
+    async def done(self):
+        await asyncio.sleep(0)
+
+    async def setup(self):
+        pass
+
+    async def handle(self):
+        pass
+
+    async def teardown(self):
+        pass
+
+
+class AsyncWorkerRegistry(object):
+    def __init__(self):
+        self.registered = []
+
+    def register(self, worker_class, num_workers=1):
+        if not issubclass(worker_class, AsyncWorker):
+            raise ValueError
+        self.registered.extend([worker_class] * num_workers)
+
+    def unregister(self, worker_class):
+        self.registered.remove(worker_class)
+
+
+def register_async_worker(cls):
+    async_worker_registry.register(cls)
+    return cls
+
+async_worker_registry = AsyncWorkerRegistry()
+
+
+async def run_workers(worker_classes):
+    """Run the workers until they finish, SIGTERM and SIGINT stop them all"""
+    worker_counts = Counter()
+    workers = []
+    for worker_class in worker_classes:
+        workers.append(worker_class(worker_index=worker_counts[worker_class]))
+        worker_counts[worker_class] += 1
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, _stop_workers, workers)
+
+    tasks = [asyncio.ensure_future(worker.run()) for worker in workers]
+    try:
+        await asyncio.gather(*tasks)
+    except Exception:
+        _stop_workers(workers)
+        await asyncio.wait(tasks)
+        raise
+
+
+def _stop_workers(workers):
+    for worker in workers:
+        worker.stop()
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
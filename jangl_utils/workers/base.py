@@ -1,23 +1,71 @@
 import gevent
+import random
 import signal
+import time
+from collections import deque
+from gevent.event import Event
 from jangl_utils import logger, sentry
+from jangl_utils.workers import settings, shutdown
+from jangl_utils.workers.metrics import Metrics
+from jangl_utils.workers.recycle import log_memory_growth
 
 
 class WorkerAttemptFailed(Exception):
-    def __init__(self, worker_class, attempt, original_exc):
+    """Kept for compatibility, BaseWorker.run now restarts failed workers in place"""
+
+    def __init__(self, worker_class, attempt, original_exc, kwargs=None):
         self.worker_class = worker_class
         self.attempt = attempt
         self.original_exc = original_exc
+        self.kwargs = kwargs or {}
 
     def attempt_worker(self):
-        return self.worker_class.spawn(attempt=self.attempt).get()
+        return self.worker_class.spawn(attempt=self.attempt, **self.kwargs).get()
 
 
 class BaseWorker(object):
+    """Greenlet worker running setup(), then handle() in a loop, then teardown()
+
+    A worker that raises is torn down and restarted in the same greenlet after
+    an exponential backoff from ``restart_backoff`` to ``restart_backoff_max``
+    seconds, randomized by ``restart_jitter``. Once it fails ``max_attempts`` times
+    within ``restart_period`` seconds the error is raised instead. ``restarts``
+    counts the restarts so far.
+
+    With ``instrument`` on, every handle() is timed into the ``handle_seconds``
+    histogram, and every ``metrics_interval`` seconds the ``iterations_per_second``
+    and ``busy_ratio`` gauges are updated; time spent in wait() counts as idle.
+
+    A worker is recycled, torn down and set up again right away, after
+    ``recycle_after_handled`` units of work, messages or tasks as counted by
+    count_handled(), or ``recycle_after_seconds`` seconds since setup, whichever comes
+    first, or once recycle_all_workers() asks for it. The process wide memory limit is
+    WORKER_MAX_RSS_MB.
+
+    Setup waits for ``ready``, either a gevent Event or a callable checked every
+    ``sleep_time`` until it returns True, and for the workers named in ``depends_on``
+    to be ready. A worker is ready once set up, or once it calls mark_ready() itself
+    when ``ready_after_setup`` is off; with several instances the first one counts.
+    Readiness is only shared within a process, the workers command keeps a worker and
+    its dependencies in the same one. A worker still waiting at shutdown just stops.
+
+    ``state`` is one of waiting, setup, running, recycling, restarting, failed or
+    stopped, and ``last_done`` the time of the last done() call.
+    """
     sleep_time = 0.1
     max_attempts = 3
+    restart_period = 300
+    restart_backoff = 1
+    restart_backoff_max = 60
+    restart_jitter = 0.5
+    instrument = True
+    metrics_interval = 10
+    recycle_after_handled = None
+    recycle_after_seconds = None
     worker_name = None
     ready = None
+    depends_on = ()
+    ready_after_setup = True
     thread = None
 
     @classmethod
@@ -27,54 +75,172 @@ class BaseWorker(object):
         self.start()
         return self.thread
 
-    def __init__(self, attempt=0, **kwargs):
+    def __init__(self, attempt=0, worker_index=0, **kwargs):
         self.attempt = attempt + 1
+        self.worker_index = worker_index
         self.kwargs = kwargs
         self.logger = logger
+        self.metrics = Metrics()
+        self.restarts = 0
+        self.recycles = 0
+        self.handled = 0
+        self.recycle_pending = False
+        self.setup_time = None
+        self.failure_times = deque()
+        self.iterations = 0
+        self.idle_seconds = 0.0
+        self.handle_seconds = self.metrics.histogram('handle_seconds')
+        self.last_metrics = (time.time(), 0, 0.0)
+        self.state = 'waiting'
+        self.last_done = None
 
     def __repr__(self):
         return '<{} - Attempt: {}>'.format(self.__class__.__name__, self.attempt)
 
     def start(self):
         self.thread = gevent.spawn(self.run)
+        worker_registry.running.append(self)
         setup_kill_signals()
 
     def run(self):
-        logger.info('run: attempt %d - %s', self.attempt, gevent.getcurrent())
-        # Wrap main try block to catch failed attempt and call teardown before next attempt
-        try:
+        while True:
+            logger.info('run: attempt %d - %s', self.attempt, gevent.getcurrent())
+            set_up = False
             try:
-                if self.ready is not None:
+                if self.ready is not None or self.depends_on:
+                    self.state = 'waiting'
                     logger.info('{} setup waiting'.format(self.__class__.__name__))
-                    while not self.ready():
-                        self.wait()
+                    if not self.wait_ready():
+                        self.state = 'stopped'
+                        return
                     logger.info('{} setup ready'.format(self.__class__.__name__))
+                self.state = 'setup'
+                set_up = True
                 self.setup()
+                if self.ready_after_setup:
+                    self.mark_ready()
+                self.state = 'running'
+                self.handled = 0
+                self.recycle_pending = False
+                self.setup_time = time.time()
                 while True:
-                    self.handle()
+                    if self.instrument:
+                        self.timed_handle()
+                    else:
+                        self.handle()
                     if _KILL_ALL_WORKERS:
+                        self.state = 'stopped'
+                        return
+                    reason = self.should_recycle()
+                    if reason:
+                        logger.info('recycling %s after %s', self.__class__.__name__, reason)
+                        self.state = 'recycling'
                         break
             except (KeyboardInterrupt, SystemExit, gevent.GreenletExit):
-                pass
+                self.state = 'stopped'
+                return
             except Exception as exc:
                 logger.error('Unrecoverable error %s: %r', gevent.getcurrent(), exc, exc_info=True)
                 sentry.captureException()
-                if self.attempt < self.max_attempts:
-                    exc = WorkerAttemptFailed(self.__class__, self.attempt, original_exc=exc)
-                raise exc
+                if not self.should_restart():
+                    self.state = 'failed'
+                    raise
+                self.state = 'restarting'
             finally:
-                logger.warning('tearing down greenlet %s', gevent.getcurrent())
-                with sentry.capture_on_error(raise_error=False):
-                    self.teardown()
+                if set_up:
+                    logger.warning('tearing down greenlet %s', gevent.getcurrent())
+                    with sentry.capture_on_error(raise_error=False):
+                        self.teardown()
+
+            if self.state == 'recycling':
+                log_memory_growth()
+                self.recycles += 1
+                self.metrics.counter('recycles').inc()
+                continue
+
+            delay = self.get_restart_delay()
+            logger.warning('restarting %s in %.1fs', self.__class__.__name__, delay)
+            gevent.sleep(delay)
+            if _KILL_ALL_WORKERS:
+                self.state = 'stopped'
+                return
+            self.attempt += 1
+            self.restarts += 1
+            self.metrics.counter('restarts').inc()
+
+    def wait_ready(self):
+        """Wait for ready and depends_on, False when the workers are killed meanwhile"""
+        events = [worker_registry.ready_event(dependency) for dependency in self.depends_on]
+        if isinstance(self.ready, Event):
+            events.append(self.ready)
+        for event in events:
+            gevent.wait([event, _KILL_EVENT], count=1)
+            if _KILL_ALL_WORKERS:
+                return False
+        if self.ready is not None and not isinstance(self.ready, Event):
+            while not self.ready():
+                if _KILL_ALL_WORKERS:
+                    return False
+                self.wait()
+        return True
+
+    def mark_ready(self):
+        """Let the workers depending on this one start"""
+        worker_registry.ready_event(worker_key(self.__class__)).set()
+
+    def should_restart(self):
+        """Record a failure, False once there were max_attempts within restart_period"""
+        now = time.time()
+        self.failure_times.append(now)
+        while self.failure_times[0] < now - self.restart_period:
+            self.failure_times.popleft()
+        return len(self.failure_times) < self.max_attempts
+
+    def should_recycle(self):
+        """Why the worker should be recycled now, or None"""
+        if self.recycle_pending:
+            return 'a recycle request'
+        if self.recycle_after_handled and self.handled >= self.recycle_after_handled:
+            return '{} handled'.format(self.handled)
+        if self.recycle_after_seconds and time.time() - self.setup_time >= self.recycle_after_seconds:
+            return '{:.0f}s'.format(time.time() - self.setup_time)
+
+    def get_restart_delay(self):
+        delay = min(self.restart_backoff * 2 ** (len(self.failure_times) - 1), self.restart_backoff_max)
+        return delay * random.uniform(1 - self.restart_jitter, 1 + self.restart_jitter)
 
-        except WorkerAttemptFailed as exc:
-            self.wait()
-            exc.attempt_worker()
+    def timed_handle(self):
+        start = time.time()
+        self.handle()
+        end = time.time()
+        self.handle_seconds.observe(end - start)
+        self.iterations += 1
+        if end - self.last_metrics[0] >= self.metrics_interval:
+            self.update_loop_metrics(end)
 
-    def wait(self):
-        gevent.sleep(self.sleep_time)
+    def update_loop_metrics(self, now):
+        last_time, last_iterations, last_idle = self.last_metrics
+        elapsed = now - last_time
+        self.metrics.gauge('iterations_per_second').set((self.iterations - last_iterations) / elapsed)
+        self.metrics.gauge('busy_ratio').set(max(0.0, 1 - (self.idle_seconds - last_idle) / elapsed))
+        self.last_metrics = (now, self.iterations, self.idle_seconds)
+
+    def get_worker_identity(self):
+        """A name for this worker that stays the same across restarts and deploys"""
+        return '{}.{}.{}'.format(settings.WORKER_IDENTITY, self.worker_name or self.__class__.__name__,
+                                 self.worker_index)
+
+    def count_handled(self, count=1):
+        """Record units of work done, towards recycle_after_handled"""
+        self.handled += count
+
+    def wait(self, seconds=None):
+        start = time.time()
+        gevent.sleep(self.sleep_time if seconds is None else seconds)
+        self.idle_seconds += time.time() - start
 
     def done(self):
+        self.last_done = time.time()
         gevent.sleep(0)
 
     def setup(self):
@@ -88,9 +254,41 @@ class BaseWorker(object):
 
 
 def kill_all_workers(*args):
+    """Stop every worker after its current handle() and start the shutdown deadline
+
+    Workers tear down as usual, finishing in-flight work, flushing and committing.
+    Those still running at the deadline are killed.
+    """
     global _KILL_ALL_WORKERS
+    if _KILL_ALL_WORKERS:
+        return
     _KILL_ALL_WORKERS = True
+    _KILL_EVENT.set()
+    shutdown.begin_shutdown(settings.SHUTDOWN_TIMEOUT)
+    gevent.spawn(_kill_at_deadline)
 _KILL_ALL_WORKERS = False
+_KILL_EVENT = Event()
+
+
+def recycle_all_workers(*args):
+    """Recycle every worker of this process after its current handle(), without exiting
+
+    Used instead of exiting when no supervisor would start a new process. What the
+    workers free is not always returned to the OS, the resident memory may stay high.
+    """
+    logger.warning('recycling %d workers in place, freed memory may not be returned to the OS',
+                   len(worker_registry.running))
+    for worker in worker_registry.running:
+        worker.recycle_pending = True
+
+
+def _kill_at_deadline():
+    gevent.sleep(shutdown.remaining())
+    stragglers = [worker.thread for worker in worker_registry.running
+                  if worker.thread is not None and not worker.thread.dead]
+    if stragglers:
+        logger.warning('shutdown deadline passed, killing %d workers', len(stragglers))
+        gevent.killall(stragglers, block=False)
 
 
 def setup_kill_signals():
@@ -105,6 +303,10 @@ _signals_already_setup = False
 
 class WorkerRegistry(object):
     registered = []
+    # Worker instances started in this process
+    running = []
+    # Readiness of the workers of this process by name
+    ready_events = {}
 
     def register(self, registry, num_workers=1):
         if not issubclass(registry, BaseWorker):
@@ -114,6 +316,21 @@ class WorkerRegistry(object):
     def unregister(self, section):
         self.registered.remove(section)
 
+    def ready_event(self, worker):
+        """The Event set once a worker is ready, by worker name or class"""
+        worker = worker_key(worker)
+        event = self.ready_events.get(worker)
+        if event is None:
+            event = self.ready_events[worker] = Event()
+        return event
+
+
+def worker_key(worker):
+    """The name readiness and depends_on refer to a worker by, from its name or class"""
+    if isinstance(worker, type):
+        return worker.worker_name or worker.__name__
+    return worker
+
 
 def register_worker(cls):
     worker_registry.register(cls)
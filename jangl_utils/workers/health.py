@@ -0,0 +1,177 @@
+import json
+import socket
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+from gevent.pywsgi import WSGIServer
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.request import urlopen
+
+from jangl_utils import logger
+from jangl_utils.workers.metrics import process_metrics
+
+__all__ = ['HealthApp', 'SupervisorHealthApp', 'start_health_server', 'start_supervisor_health_server']
+
+
+class HealthApp(object):
+    """WSGI app reporting on the workers of this process
+
+    - /health: 200 unless a worker failed, or a running worker hasn't called done()
+      for ``stale_after`` seconds
+    - /ready: 200 once every worker is running
+    - /metrics: JSON with the state, restarts and metrics of every worker, and the
+      process metrics
+
+    Everything is read from the workers on request, the worker loops do no extra work.
+    """
+
+    def __init__(self, workers, stale_after=60):
+        self.workers = workers
+        self.stale_after = stale_after
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '').rstrip('/')
+        if path == '/health':
+            ok, body = self.health()
+        elif path == '/ready':
+            ok, body = self.ready()
+        elif path == '/metrics':
+            ok, body = True, self.metrics()
+        else:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+
+        content = json.dumps(body, sort_keys=True).encode('utf-8')
+        start_response('200 OK' if ok else '503 Service Unavailable',
+                       [('Content-Type', 'application/json'), ('Content-Length', str(len(content)))])
+        return [content]
+
+    def health(self):
+        now = time.time()
+        unhealthy = [self.describe(worker, now) for worker in self.workers
+                     if worker.state == 'failed' or (worker.state == 'running' and self.is_stale(worker, now))]
+        return not unhealthy, {'unhealthy': unhealthy}
+
+    def ready(self):
+        now = time.time()
+        not_ready = [self.describe(worker, now) for worker in self.workers if worker.state != 'running']
+        return not not_ready, {'not_ready': not_ready}
+
+    def metrics(self):
+        now = time.time()
+        return {
+            'workers': [dict(self.describe(worker, now), metrics=worker.metrics.snapshot())
+                        for worker in self.workers],
+            'process': process_metrics.snapshot(),
+        }
+
+    def is_stale(self, worker, now):
+        return worker.last_done is not None and now - worker.last_done > self.stale_after
+
+    def describe(self, worker, now):
+        return {
+            'worker': worker.worker_name or worker.__class__.__name__,
+            'index': worker.worker_index,
+            'state': worker.state,
+            'attempt': worker.attempt,
+            'restarts': worker.restarts,
+            'seconds_since_done': now - worker.last_done if worker.last_done is not None else None,
+        }
+
+
+class SupervisorHealthApp(HealthApp):
+    """WSGI app reporting on the child processes of a ProcessSupervisor
+
+    Each child serves its own HealthApp on ``child_port(index)``, which is queried
+    on request with a ``timeout``:
+    - /health: 200 unless a child crashed and waits to be restarted, or a running
+      child answers its /health with an error or not in time. A child that isn't
+      listening yet ``stale_after`` seconds after it started is unhealthy too
+    - /ready: 200 once every running child answers its /ready with 200
+    - /metrics: JSON with the /metrics of every running child
+    """
+
+    def __init__(self, supervisor, child_port, stale_after=60, timeout=2):
+        self.supervisor = supervisor
+        self.child_port = child_port
+        self.stale_after = stale_after
+        self.timeout = timeout
+
+    def health(self):
+        unhealthy = []
+        for child in self.supervisor.children:
+            if child.restart_at is not None:
+                unhealthy.append(self.describe_child(child, 'restarting'))
+            elif child.pid:
+                ok, body = self.query(child, '/health')
+                if not ok and (body is not None or time.time() - child.started > self.stale_after):
+                    unhealthy.append(self.describe_child(child, 'unhealthy', body))
+        return not unhealthy, {'unhealthy': unhealthy}
+
+    def ready(self):
+        not_ready = []
+        for child in self.supervisor.children:
+            if child.restart_at is not None:
+                not_ready.append(self.describe_child(child, 'restarting'))
+            elif child.pid:
+                ok, body = self.query(child, '/ready')
+                if not ok:
+                    not_ready.append(self.describe_child(child, 'not_ready', body))
+        return not not_ready, {'not_ready': not_ready}
+
+    def metrics(self):
+        return {'processes': [self.describe_child(child, 'running', self.query(child, '/metrics')[1])
+                              for child in self.supervisor.children if child.pid]}
+
+    def query(self, child, path):
+        """Ask a child for ``path``, returns whether it answered 200 and its decoded body"""
+        url = 'http://127.0.0.1:{}{}'.format(self.child_port(child.index), path)
+        try:
+            response = urlopen(url, timeout=self.timeout)
+            return True, json.loads(response.read().decode('utf-8'))
+        except HTTPError as exc:
+            try:
+                return False, json.loads(exc.read().decode('utf-8'))
+            except ValueError:
+                return False, {'error': str(exc)}
+        except (socket.timeout, URLError) as exc:
+            if isinstance(exc, socket.timeout) or isinstance(getattr(exc, 'reason', None), socket.timeout):
+                return False, {'error': 'no answer within {}s'.format(self.timeout)}
+            # Not listening yet
+            return False, None
+        except Exception as exc:
+            return False, {'error': repr(exc)}
+
+    def describe_child(self, child, state, body=None):
+        return {
+            'process': child.index,
+            'pid': child.pid,
+            'state': state,
+            'seconds_since_start': time.time() - child.started if child.started else None,
+            'response': body,
+        }
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def start_supervisor_health_server(port, supervisor, child_port, host='0.0.0.0', stale_after=60):
+    """Serve a SupervisorHealthApp from a thread, the supervisor itself doesn't run gevent"""
+    server = make_server(host, port, SupervisorHealthApp(supervisor, child_port, stale_after),
+                         handler_class=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name='supervisor-health')
+    thread.daemon = True
+    thread.start()
+    logger.info('serving worker process health on %s:%d', host, port)
+    return server
+
+
+def start_health_server(port, workers, host='0.0.0.0', stale_after=60):
+    """Serve a HealthApp for ``workers`` from a greenlet of this process"""
+    server = WSGIServer((host, port), HealthApp(workers, stale_after), log=None)
+    server.start()
+    logger.info('serving worker health on %s:%d', host, port)
+    return server
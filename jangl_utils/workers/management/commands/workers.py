@@ -1,9 +1,22 @@
 import importlib
+import sys
+from collections import Counter
+from functools import partial
+
 import gevent
 from django.conf import settings
 from django.core.management import BaseCommand, CommandError
+from django.db import connections
 
-from jangl_utils.workers.base import worker_registry, kill_all_workers
+from jangl_utils.workers import settings as worker_settings
+from jangl_utils.workers.base import worker_registry, worker_key, kill_all_workers, recycle_all_workers
+from jangl_utils.workers.health import start_health_server
+from jangl_utils.workers.monitor import start_blocking_monitor
+from jangl_utils.workers.processes import ProcessSupervisor
+from jangl_utils.workers.recycle import (RECYCLE_EXIT_CODE, recycle_requested, start_memory_tracing,
+                                         start_memory_watchdog)
+from jangl_utils.workers.shutdown import run_shutdown_hooks
+from jangl_utils.workers.threads import reset_threadpool
 
 
 class Command(BaseCommand):
@@ -11,18 +24,138 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('args', metavar='worker_name', nargs='+', help='Run specific workers')
+        parser.add_argument('--asyncio', action='store_true', help='Run asyncio workers instead of gevent workers')
+        parser.add_argument('--processes', type=int, default=0,
+                            help='Split the workers between this many supervised child processes, '
+                                 'keeping workers with their depends_on together')
+        parser.add_argument('--per-worker', action='store_true',
+                            help='Run every worker, counting num_workers of each, in its own child process, '
+                                 'workers with their depends_on sharing one')
+        parser.add_argument('--health-port', type=int, default=worker_settings.HEALTH_PORT,
+                            help='Serve /health, /ready and /metrics on this port, with child processes '
+                                 'aggregated from the following ports they serve their own on')
 
     def handle(self, *worker_names, **options):
-        workers = [w.spawn() for w in find_workers(worker_names)]
-        if not workers:
+        if options['asyncio']:
+            return self.handle_asyncio(worker_names)
+
+        worker_specs = []
+        worker_counts = Counter()
+        for worker_class in find_workers(worker_names):
+            worker_specs.append((worker_class, worker_counts[worker_class]))
+            worker_counts[worker_class] += 1
+        if not worker_specs:
             raise CommandError('Could not find workers')
-        try:
-            gevent.joinall(workers, raise_error=True)
-        except:
-            kill_all_workers()
+
+        groups = group_dependent_workers(worker_specs)
+        processes = len(groups) if options['per_worker'] else min(options['processes'], len(groups))
+        if processes > 1:
+            # Children must not share the parent's database connections
+            connections.close_all()
+            health_port = options['health_port']
+            targets = [partial(run_workers, [spec for group in groups[i::processes] for spec in group],
+                               health_port and health_port + 1 + i, supervised=True)
+                       for i in range(processes)]
+            ProcessSupervisor(targets, stop_timeout=worker_settings.SHUTDOWN_TIMEOUT + 5, health_port=health_port,
+                              health_stale_after=worker_settings.HEALTH_STALE_AFTER).run()
+        else:
+            status = run_workers(worker_specs, options['health_port'])
+            if status:
+                sys.exit(status)
+
+    def handle_asyncio(self, worker_names):
+        import asyncio
+        from jangl_utils.workers.aio import async_worker_registry, run_workers
+
+        worker_classes = find_workers(worker_names, async_worker_registry)
+        if not worker_classes:
+            raise CommandError('Could not find workers')
+        asyncio.run(run_workers(worker_classes))
+
+
+def run_workers(worker_specs, health_port=None, supervised=False):
+    """Spawn (worker_class, worker_index) pairs and wait for them, returns an exit status
+
+    Going over WORKER_MAX_RSS_MB in a ``supervised`` child stops the workers with
+    status RECYCLE_EXIT_CODE for the supervisor to start a new process. Without a
+    supervisor the workers are recycled in place instead, the process keeps running.
+    """
+    gevent.reinit()
+    # Python 2 has no fork hooks to do it for forked children
+    reset_threadpool()
+    if worker_settings.MAX_BLOCKING_TIME:
+        start_blocking_monitor(worker_settings.MAX_BLOCKING_TIME)
+    if worker_settings.TRACE_MEMORY:
+        start_memory_tracing()
+    watchdog = None
+    if worker_settings.MAX_RSS_MB:
+        watchdog = start_memory_watchdog(worker_settings.MAX_RSS_MB, worker_settings.MEMORY_CHECK_INTERVAL,
+                                         kill_all_workers if supervised else recycle_all_workers,
+                                         in_place=not supervised)
+    workers = [worker_class.spawn(worker_index=worker_index) for worker_class, worker_index in worker_specs]
+    health_server = None
+    if health_port:
+        health_server = start_health_server(health_port, worker_registry.running,
+                                            stale_after=worker_settings.HEALTH_STALE_AFTER)
+    status = 0
+    try:
+        gevent.joinall(workers, raise_error=True)
+    except:
+        status = 1
+        kill_all_workers()
+        # Let the other workers drain, the shutdown deadline kills the ones that don't stop
+        gevent.joinall(workers)
+    finally:
+        run_shutdown_hooks()
+        if health_server is not None:
+            health_server.stop()
+        if watchdog is not None:
+            watchdog.kill()
+    if status == 0 and recycle_requested():
+        status = RECYCLE_EXIT_CODE
+    return status
+
+
+def group_dependent_workers(worker_specs):
+    """Split (worker_class, worker_index) pairs into groups that must share a process
+
+    Readiness is only known within a process, so a worker goes with every instance of
+    the workers it depends on. Each other instance is a group of its own.
+    """
+    keys = set(worker_key(worker_class) for worker_class, _ in worker_specs)
+    parents = {}
+
+    def find(key):
+        while parents.get(key, key) != key:
+            key = parents[key]
+        return key
+
+    for worker_class, _ in worker_specs:
+        for dependency in worker_class.depends_on:
+            dependency = worker_key(dependency)
+            if dependency not in keys:
+                raise CommandError('{} depends on {}, which is not among the workers to run'.format(
+                    worker_key(worker_class), dependency))
+            root, dependency_root = find(worker_key(worker_class)), find(dependency)
+            if root != dependency_root:
+                parents[dependency_root] = root
+
+    groups = []
+    shared = {}
+    for spec in worker_specs:
+        key = worker_key(spec[0])
+        if key not in parents and find(key) not in parents.values():
+            groups.append([spec])
+            continue
+        group = shared.get(find(key))
+        if group is None:
+            group = shared[find(key)] = []
+            groups.append(group)
+        group.append(spec)
+    return groups
 
 
-def find_workers(worker_names):
+def find_workers(worker_names, registry=worker_registry):
     for app in settings.INSTALLED_APPS:
         if app.startswith('jangl_utils'):
             continue
@@ -32,7 +165,7 @@ def find_workers(worker_names):
         except ImportError:
             pass
 
-    workers = worker_registry.registered
+    workers = registry.registered
     if worker_names:
         workers = [w for w in workers if w.worker_name in worker_names]
     return workers
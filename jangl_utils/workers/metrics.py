@@ -0,0 +1,107 @@
+import bisect
+import threading
+
+__all__ = ['Metrics', 'Counter', 'Gauge', 'Histogram', 'process_metrics']
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """Counts of observed values per bucket, plus their count and sum
+
+    ``counts[i]`` holds the values up to ``buckets[i]``, the last count the values above every bucket.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {
+            'buckets': dict(zip([str(bucket) for bucket in self.buckets] + ['+Inf'], self.counts)),
+            'count': self.count,
+            'sum': self.sum,
+        }
+
+
+class Metrics(object):
+    """Named counters, gauges and histograms, each optionally split by labels
+
+    >>> metrics.counter('messages', topic='orders').inc()
+    >>> metrics.histogram('message_seconds', topic='orders').observe(0.02)
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, buckets)
+
+    def _get(self, metric_class, name, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = metric_class(*args)
+        elif not isinstance(metric, metric_class):
+            raise TypeError('Metric {} is a {}'.format(name, type(metric).__name__))
+        return metric
+
+    def snapshot(self):
+        """All metrics as a list of dicts with their name, type, labels and value"""
+        with self.lock:
+            items = list(self.metrics.items())
+        return [{
+            'name': name,
+            'type': type(metric).__name__.lower(),
+            'labels': dict(labels),
+            'value': metric.snapshot(),
+        } for (name, labels), metric in sorted(items, key=lambda item: item[0])]
+
+
+# Metrics of the whole process rather than of one worker
+process_metrics = Metrics()
@@ -0,0 +1,31 @@
+from django.db import models
+from django.utils import timezone
+
+
+class QueuedTask(models.Model):
+    """Abstract task of a database queue run by a QueueWorker
+
+    Subclasses add the fields describing the work to do.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    run_after = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        abstract = True
+        index_together = [('status', 'run_after')]
@@ -0,0 +1,27 @@
+import gevent
+import gevent.events
+
+from jangl_utils import logger
+from jangl_utils.workers.metrics import process_metrics
+
+__all__ = ['start_blocking_monitor']
+
+
+def start_blocking_monitor(max_blocking_time):
+    """Log a stack trace whenever the gevent hub is blocked for more than ``max_blocking_time`` seconds
+
+    gevent checks from a separate monitor thread, so the worker loops pay nothing for it.
+    Blocks are also counted in the ``hub_blocked`` process metric.
+    """
+    gevent.config.max_blocking_time = max_blocking_time
+    gevent.config.monitor_thread = True
+    if _log_blocked not in gevent.events.subscribers:
+        gevent.events.subscribers.append(_log_blocked)
+    gevent.get_hub().start_periodic_monitoring_thread()
+
+
+def _log_blocked(event):
+    if isinstance(event, gevent.events.EventLoopBlocked):
+        process_metrics.counter('hub_blocked').inc()
+        logger.warning('gevent hub blocked for more than %.3fs by %s\n%s',
+                       event.blocking_time, event.greenlet, '\n'.join(event.info))
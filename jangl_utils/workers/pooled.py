@@ -0,0 +1,134 @@
+import math
+import time
+
+import gevent
+
+from jangl_utils import logger, sentry
+from jangl_utils.workers import shutdown
+from jangl_utils.workers.base import BaseWorker
+
+__all__ = ['PooledWorker']
+
+
+class PooledWorker(BaseWorker):
+    """Greenlets calling work() in a loop, sharing one setup, as many as the load needs
+
+    Implement ``work(self)``, doing one unit of work and returning False when there
+    was nothing to do; everything set up in setup() is shared by the greenlets.
+
+    Every ``scale_interval`` seconds the pool is resized between ``min_concurrency``
+    and ``max_concurrency``:
+    - Above ``target_latency`` seconds per work() on average it shrinks by
+      ``scale_down_factor``, whatever the backlog, to relieve what work() waits on
+    - Otherwise when get_backlog() returns the number of items waiting, e.g. a queue
+      depth or a consumer lag, it gets one greenlet per ``backlog_per_greenlet`` items
+    - Otherwise it grows by half above ``scale_up_utilization`` of the greenlets' time
+      spent working, and loses one below ``scale_down_utilization``
+
+    Greenlets removed finish their current work() first. An error in work() stops
+    the pool and restarts the worker.
+    """
+    min_concurrency = 1
+    max_concurrency = 50
+    scale_interval = 5
+    target_latency = None
+    scale_down_factor = 0.75
+    backlog_per_greenlet = 10
+    scale_up_utilization = 0.8
+    scale_down_utilization = 0.3
+    drain_timeout = 10
+    concurrency = 0
+    greenlets = None
+
+    def setup(self):
+        self.greenlets = {}
+        self.failure = None
+        self.busy_seconds = 0.0
+        self.work_count = 0
+        self.work_seconds = self.metrics.histogram('work_seconds')
+        self.last_scale = (time.time(), 0.0, 0, 0.0)
+        self.resize(self.min_concurrency)
+
+    def teardown(self):
+        if self.greenlets:
+            self.concurrency = 0
+            greenlets = list(self.greenlets.values())
+            gevent.joinall(greenlets, timeout=shutdown.remaining(self.drain_timeout))
+            gevent.killall(greenlets)
+            self.greenlets = None
+
+    def handle(self):
+        if self.failure is not None:
+            raise self.failure
+        if time.time() - self.last_scale[0] >= self.scale_interval:
+            self.scale()
+        self.wait()
+        self.done()
+
+    def scale(self):
+        now = time.time()
+        last_time, last_busy, last_count, last_sum = self.last_scale
+        elapsed = now - last_time
+        count = self.work_count - last_count
+        utilization = (self.busy_seconds - last_busy) / (elapsed * self.concurrency) if self.concurrency else 1.0
+        latency = (self.work_seconds.sum - last_sum) / count if count else None
+        self.last_scale = (now, self.busy_seconds, self.work_count, self.work_seconds.sum)
+
+        desired = self.get_desired_concurrency(utilization, latency)
+        desired = max(self.min_concurrency, min(desired, self.max_concurrency))
+        if desired != self.concurrency:
+            logger.info('scaling %s from %d to %d greenlets (utilization %.2f, latency %s)',
+                        self.__class__.__name__, self.concurrency, desired, utilization,
+                        '{:.3f}s'.format(latency) if latency is not None else '-')
+            self.resize(desired)
+        self.metrics.gauge('utilization').set(utilization)
+
+    def get_desired_concurrency(self, utilization, latency):
+        current = self.concurrency
+        if self.target_latency and latency is not None and latency > self.target_latency:
+            return min(int(current * self.scale_down_factor), current - 1)
+        backlog = self.get_backlog()
+        if backlog is not None:
+            self.metrics.gauge('backlog').set(backlog)
+            return int(math.ceil(backlog / float(self.backlog_per_greenlet)))
+        if utilization > self.scale_up_utilization:
+            return int(math.ceil(current * 1.5))
+        if utilization < self.scale_down_utilization:
+            return current - 1
+        return current
+
+    def resize(self, concurrency):
+        self.concurrency = concurrency
+        for index in range(concurrency):
+            greenlet = self.greenlets.get(index)
+            if greenlet is None or greenlet.dead:
+                self.greenlets[index] = gevent.spawn(self.run_greenlet, index)
+        self.metrics.gauge('concurrency').set(concurrency)
+
+    def run_greenlet(self, index):
+        try:
+            while index < self.concurrency and self.failure is None:
+                start = time.time()
+                worked = self.work()
+                elapsed = time.time() - start
+                if worked is False:
+                    gevent.sleep(self.sleep_time)
+                    continue
+                self.busy_seconds += elapsed
+                self.work_count += 1
+                self.count_handled()
+                self.work_seconds.observe(elapsed)
+        except Exception as exc:
+            logger.error('%s greenlet %d failed: %r', self.__class__.__name__, index, exc, exc_info=True)
+            sentry.captureException()
+            self.failure = exc
+        finally:
+            if self.greenlets is not None and self.greenlets.get(index) is gevent.getcurrent():
+                del self.greenlets[index]
+
+    def get_backlog(self):
+        """Number of items waiting to be worked on, or None when unknown"""
+        return None
+
+    def work(self):
+        raise NotImplementedError
@@ -0,0 +1,158 @@
+import os
+import signal
+import time
+
+from jangl_utils import logger
+from jangl_utils.workers.health import start_supervisor_health_server
+from jangl_utils.workers.recycle import RECYCLE_EXIT_CODE
+
+__all__ = ['ProcessSupervisor']
+
+
+class ChildProcess(object):
+    def __init__(self, index, target):
+        self.index = index
+        self.target = target
+        self.pid = None
+        self.started = None
+        self.failures = 0
+        self.restart_at = None
+
+
+class ProcessSupervisor(object):
+    """Runs each target in a forked child process and restarts the ones that crash
+
+    A target is a callable run in the child, its return value is the child's exit
+    status. A child exiting with a non-zero status is restarted after a backoff that
+    doubles with every crash, from ``min_backoff`` up to ``max_backoff`` seconds, and
+    resets once a child has been up for ``stable_after`` seconds. A child exiting with
+    status 0 is done and not restarted. One exiting with RECYCLE_EXIT_CODE asked to be
+    replaced and is restarted right away.
+
+    SIGTERM and SIGINT are forwarded to the children as SIGTERM so they can drain.
+    Children still running ``stop_timeout`` seconds later are killed.
+
+    With ``health_port`` the supervisor serves the health of all the children on it,
+    each child being expected to serve its own on ``health_port + 1 + index``.
+    """
+    min_backoff = 1
+    max_backoff = 60
+    stable_after = 60
+    stop_timeout = 30
+    check_interval = 0.5
+    health_port = None
+    health_stale_after = 60
+    health_server = None
+
+    def __init__(self, targets, **options):
+        self.children = [ChildProcess(index, target) for index, target in enumerate(targets)]
+        self.stopping = False
+        for name, value in options.items():
+            if not hasattr(self, name):
+                raise TypeError('Unknown option {}'.format(name))
+            setattr(self, name, value)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if self.health_port:
+            self.health_server = start_supervisor_health_server(
+                self.health_port, self, self.child_health_port, stale_after=self.health_stale_after)
+        for child in self.children:
+            self.start(child)
+
+        while not self.stopping and any(child.pid or child.restart_at for child in self.children):
+            self.reap()
+            now = time.time()
+            for child in self.children:
+                if child.restart_at is not None and child.restart_at <= now:
+                    self.start(child)
+            time.sleep(self.check_interval)
+
+        self.shutdown()
+
+    def start(self, child):
+        child.restart_at = None
+        child.started = time.time()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                if self.health_server is not None:
+                    # The serving thread doesn't exist in the child, only its socket does
+                    self.health_server.socket.close()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                status = child.target()
+            except BaseException:
+                logger.exception('worker process %d failed', child.index)
+            finally:
+                os._exit(status or 0)
+        child.pid = pid
+        logger.info('started worker process %d (pid %d)', child.index, pid)
+
+    def child_health_port(self, index):
+        return self.health_port + 1 + index
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if pid == 0:
+                return
+            child = next((child for child in self.children if child.pid == pid), None)
+            if child is not None:
+                self.exited(child, status)
+
+    def exited(self, child, status):
+        child.pid = None
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        if code == 0 or self.stopping:
+            logger.info('worker process %d exited with %d', child.index, code)
+            return
+        if code == RECYCLE_EXIT_CODE:
+            logger.info('worker process %d recycled, restarting', child.index)
+            child.restart_at = time.time()
+            return
+
+        if time.time() - child.started >= self.stable_after:
+            child.failures = 0
+        delay = min(self.min_backoff * 2 ** child.failures, self.max_backoff)
+        child.failures += 1
+        child.restart_at = time.time() + delay
+        logger.error('worker process %d exited with %d, restarting in %.1fs', child.index, code, delay)
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def shutdown(self):
+        running = [child for child in self.children if child.pid]
+        for child in running:
+            logger.info('stopping worker process %d (pid %d)', child.index, child.pid)
+            self.signal(child, signal.SIGTERM)
+
+        deadline = time.time() + self.stop_timeout
+        while any(child.pid for child in self.children) and time.time() < deadline:
+            self.reap()
+            time.sleep(self.check_interval)
+
+        for child in self.children:
+            if child.pid:
+                logger.warning('killing worker process %d (pid %d)', child.index, child.pid)
+                self.signal(child, signal.SIGKILL)
+                if child.pid:
+                    os.waitpid(child.pid, 0)
+                    child.pid = None
+
+        if self.health_server is not None:
+            self.health_server.shutdown()
+            self.health_server.server_close()
+            self.health_server = None
+
+    def signal(self, child, signum):
+        try:
+            os.kill(child.pid, signum)
+        except OSError:
+            child.pid = None
@@ -0,0 +1,176 @@
+import time
+from datetime import timedelta
+
+import gevent
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from gevent.event import Event
+from gevent.queue import Queue
+
+from jangl_utils import logger, sentry
+from jangl_utils.workers import shutdown
+from jangl_utils.workers.base import BaseWorker
+from jangl_utils.workers.models import QueuedTask
+
+__all__ = ['QueueWorker']
+
+
+class QueueWorker(BaseWorker):
+    """Runs the tasks of a QueuedTask model
+
+    Implement ``process_task(self, task)``. Pending tasks whose run_after has come are
+    claimed in batches with ``SELECT ... FOR UPDATE SKIP LOCKED``, so any number of
+    workers can share a queue, and run by ``concurrency`` long-lived greenlets. Under
+    gevent monkey patching each greenlet has its own database connection, kept for
+    its lifetime rather than opened per task. Finished tasks are marked done (or
+    deleted with ``delete_done``) in bulk after each batch.
+
+    A failing task is retried after ``retry_backoff`` seconds, doubling with every
+    attempt, and marked failed after ``max_task_attempts``. Tasks left running for
+    ``claim_timeout`` seconds by a worker that died are claimed again.
+
+    Databases without row locks, like sqlite, ignore FOR UPDATE; run a single worker
+    process against those.
+    """
+    model = None
+    using = None
+    batch_size = 100
+    concurrency = 50
+    max_task_attempts = 3
+    retry_backoff = 10
+    claim_timeout = 300
+    delete_done = False
+    drain_timeout = 10
+    runners = None
+
+    def setup(self):
+        self.queue = Queue()
+        self.in_flight = 0
+        self.available = Event()
+        self.succeeded = []
+        self.failed = []
+        self.runners = [gevent.spawn(self.run_tasks) for _ in range(self.concurrency)]
+
+    def teardown(self):
+        if self.runners is not None:
+            self.release(self.drain_queue())
+            for _ in self.runners:
+                self.queue.put(StopIteration)
+            gevent.joinall(self.runners, timeout=shutdown.remaining(self.drain_timeout))
+            # Tasks killed mid-run stay running and are claimed again after claim_timeout
+            gevent.killall(self.runners)
+            self.runners = None
+            self.complete()
+
+    def get_model(self):
+        if self.model is None or not issubclass(self.model, QueuedTask):
+            raise ValueError('{} needs a QueuedTask model'.format(self.__class__.__name__))
+        return self.model
+
+    def get_queryset(self):
+        return self.get_model()._default_manager.using(self.using)
+
+    def get_batch_size(self):
+        return self.batch_size
+
+    def handle(self):
+        free = self.concurrency - self.in_flight
+        tasks = self.claim(min(free, self.get_batch_size())) if free > 0 else []
+        self.in_flight += len(tasks)
+        for task in tasks:
+            self.queue.put(task)
+        self.complete()
+
+        if not tasks:
+            if free > 0:
+                self.wait()
+            else:
+                self.available.clear()
+                self.available.wait(timeout=self.sleep_time)
+        self.done()
+
+    def claim(self, limit):
+        now = timezone.now()
+        claimable = (Q(status=QueuedTask.PENDING, run_after__lte=now) |
+                     Q(status=QueuedTask.RUNNING, claimed_at__lt=now - timedelta(seconds=self.claim_timeout)))
+        queryset = self.get_queryset()
+        with transaction.atomic(using=queryset.db):
+            tasks = list(queryset.select_for_update(skip_locked=True)
+                                 .filter(claimable).order_by('run_after')[:limit])
+            if tasks:
+                queryset.filter(pk__in=[task.pk for task in tasks]).update(
+                    status=QueuedTask.RUNNING, claimed_at=now, attempts=F('attempts') + 1)
+
+        for task in tasks:
+            task.status = QueuedTask.RUNNING
+            task.claimed_at = now
+            task.attempts += 1
+        self.metrics.counter('tasks_claimed').inc(len(tasks))
+        return tasks
+
+    def run_tasks(self):
+        try:
+            for task in self.queue:
+                self.run_task(task)
+                self.in_flight -= 1
+                self.available.set()
+        finally:
+            connections.close_all()
+
+    def drain_queue(self):
+        tasks = []
+        while not self.queue.empty():
+            tasks.append(self.queue.get_nowait())
+        self.in_flight -= len(tasks)
+        return tasks
+
+    def release(self, tasks):
+        """Put claimed tasks that didn't start back in the queue"""
+        if tasks:
+            self.get_queryset().filter(pk__in=[task.pk for task in tasks]).update(
+                status=QueuedTask.PENDING, attempts=F('attempts') - 1)
+
+    def run_task(self, task):
+        start = time.time()
+        try:
+            self.process_task(task)
+        except Exception as exc:
+            logger.error('task %s failed on attempt %d: %r', task.pk, task.attempts, exc, exc_info=True)
+            sentry.captureException()
+            self.failed.append((task, exc))
+        else:
+            self.succeeded.append(task.pk)
+        finally:
+            self.metrics.histogram('task_seconds').observe(time.time() - start)
+            self.count_handled()
+
+    def complete(self):
+        """Record the tasks finished since the last call"""
+        succeeded, self.succeeded = self.succeeded, []
+        failed, self.failed = self.failed, []
+        queryset = self.get_queryset()
+        now = timezone.now()
+
+        if succeeded:
+            if self.delete_done:
+                queryset.filter(pk__in=succeeded).delete()
+            else:
+                queryset.filter(pk__in=succeeded).update(status=QueuedTask.DONE, finished_at=now)
+            self.metrics.counter('tasks_done').inc(len(succeeded))
+
+        for task, exc in failed:
+            if task.attempts >= self.max_task_attempts:
+                queryset.filter(pk=task.pk).update(status=QueuedTask.FAILED, finished_at=now, last_error=repr(exc))
+                self.metrics.counter('tasks_failed').inc()
+            else:
+                run_after = now + timedelta(seconds=self.get_retry_delay(task))
+                queryset.filter(pk=task.pk).update(status=QueuedTask.PENDING, run_after=run_after,
+                                                   last_error=repr(exc))
+                self.metrics.counter('tasks_retried').inc()
+
+    def get_retry_delay(self, task):
+        return self.retry_backoff * 2 ** (task.attempts - 1)
+
+    def process_task(self, task):
+        raise NotImplementedError
@@ -0,0 +1,90 @@
+import resource
+
+import gevent
+
+from jangl_utils import logger
+from jangl_utils.workers.metrics import process_metrics
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__all__ = ['RECYCLE_EXIT_CODE', 'get_rss', 'start_memory_watchdog', 'recycle_requested',
+           'start_memory_tracing', 'log_memory_growth']
+
+# Exit status of a worker process that stopped to be replaced by a fresh one
+RECYCLE_EXIT_CODE = 75
+
+_recycle_requested = False
+_baseline = None
+
+
+def get_rss():
+    """Resident memory of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        # No procfs, fall back to the peak in kilobytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_memory_watchdog(max_rss_mb, interval, on_exceeded, in_place=False):
+    """Check the resident memory every ``interval`` seconds, call on_exceeded() once over ``max_rss_mb``
+
+    By default the process is meant to exit and be replaced, and recycle_requested()
+    turns True. With ``in_place`` on_exceeded() recycles the workers within the
+    process instead and the watch goes on. Memory freed that way is not always
+    returned to the OS, so on_exceeded() is only called again once the resident
+    memory grows past what it was after the last recycle.
+
+    The current value goes into the ``rss_bytes`` process metric.
+    """
+    return gevent.spawn(_watch_memory, max_rss_mb * 1024 * 1024, interval, on_exceeded, in_place)
+
+
+def _watch_memory(max_rss, interval, on_exceeded, in_place):
+    global _recycle_requested
+    limit = max_rss
+    while True:
+        gevent.sleep(interval)
+        rss = get_rss()
+        process_metrics.gauge('rss_bytes').set(rss)
+        if rss > limit:
+            logger.warning('resident memory %.0fMB is over %.0fMB, recycling the %s',
+                           rss / 1048576.0, limit / 1048576.0, 'workers' if in_place else 'process')
+            log_memory_growth()
+            if not in_place:
+                _recycle_requested = True
+                on_exceeded()
+                return
+            on_exceeded()
+            # Give the workers an interval to recycle before measuring again
+            gevent.sleep(interval)
+            limit = max(max_rss, get_rss())
+
+
+def recycle_requested():
+    """True once the memory watchdog asked for this process to be recycled"""
+    return _recycle_requested
+
+
+def start_memory_tracing():
+    """Start tracemalloc and keep a snapshot to compare with, does nothing on Python 2"""
+    global _baseline
+    if tracemalloc is None:
+        logger.warning('tracemalloc is not available, not tracing memory')
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _baseline = tracemalloc.take_snapshot()
+
+
+def log_memory_growth(limit=10):
+    """Log the ``limit`` source lines whose allocations grew the most since start_memory_tracing()"""
+    if _baseline is None or not tracemalloc.is_tracing():
+        return
+    stats = tracemalloc.take_snapshot().compare_to(_baseline, 'lineno')
+    logger.warning('memory growth since start, top %d lines:\n%s', limit,
+                   '\n'.join(str(stat) for stat in stats[:limit]))
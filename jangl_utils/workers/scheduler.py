@@ -0,0 +1,286 @@
+import calendar
+import math
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from gevent.pool import Pool
+
+from jangl_utils import logger, sentry
+from jangl_utils.timezone import utc
+from jangl_utils.workers import shutdown
+from jangl_utils.workers.base import BaseWorker
+
+__all__ = ['Every', 'Cron', 'ScheduledTask', 'ScheduleRegistry', 'schedule_registry', 'scheduled',
+           'TimerWheel', 'ScheduledWorker']
+
+
+class Every(object):
+    """Every ``seconds`` seconds, at multiples of ``seconds`` after ``offset`` since the epoch"""
+
+    def __init__(self, seconds, offset=0):
+        if seconds <= 0:
+            raise ValueError('Interval must be positive')
+        self.seconds = seconds
+        self.offset = offset
+
+    def next_after(self, when):
+        return (math.floor((when - self.offset) / self.seconds) + 1) * self.seconds + self.offset
+
+    def __repr__(self):
+        return 'Every({})'.format(self.seconds)
+
+
+class Cron(object):
+    """A cron expression: minute, hour, day of month, month and day of week, in UTC
+
+    Fields take ``*``, numbers, ranges, lists and steps, e.g. ``*/15 8-18 * * 1-5``.
+    Day of week 0 and 7 are Sunday. As in cron, when both days are restricted either
+    may match.
+    """
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('Cron expression needs 5 fields: {!r}'.format(expression))
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            self.parse_field(field, low, high) for field, (low, high) in zip(fields, self.ranges)]
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def parse_field(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(value) for value in part.split('-', 1)]
+            else:
+                start = end = int(part)
+                if step != 1:
+                    end = high
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError('Invalid cron field {!r}'.format(field))
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, when):
+        dt = datetime.fromtimestamp(int(when) // 60 * 60, utc) + timedelta(minutes=1)
+        # Any expression that can match at all does so within a leap year cycle
+        last_year = dt.year + 4
+        while dt.year <= last_year:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return calendar.timegm(dt.utctimetuple())
+        raise ValueError('Cron expression never matches: {!r}'.format(self.expression))
+
+    def __repr__(self):
+        return 'Cron({!r})'.format(self.expression)
+
+
+class ScheduledTask(object):
+    def __init__(self, func, schedule, name=None):
+        self.func = func
+        self.schedule = schedule
+        self.name = name or getattr(func, '__name__', repr(func))
+
+    def __repr__(self):
+        return '<ScheduledTask {} {!r}>'.format(self.name, self.schedule)
+
+
+class ScheduleRegistry(object):
+    def __init__(self):
+        self.tasks = []
+
+    def register(self, func, every=None, cron=None, name=None):
+        if (every is None) == (cron is None):
+            raise ValueError('Give one of every or cron')
+        schedule = Every(every) if every is not None else Cron(cron)
+        task = ScheduledTask(func, schedule, name)
+        self.tasks.append(task)
+        return task
+
+    def scheduled(self, every=None, cron=None, name=None):
+        """Decorator running the function every ``every`` seconds or on a ``cron`` expression
+
+        >>> @scheduled(every=60)
+        ... def refresh_rates():
+        ...     pass
+        """
+        def decorator(func):
+            self.register(func, every=every, cron=cron, name=name)
+            return func
+        return decorator
+
+schedule_registry = ScheduleRegistry()
+scheduled = schedule_registry.scheduled
+
+
+class TimerWheel(object):
+    """Hashed timer wheel with ``size`` slots of ``tick`` seconds
+
+    Adding and popping an item is O(1) whatever the number of items; items due more
+    than one revolution ahead share a slot with nearer ones and are kept until their
+    tick comes.
+    """
+
+    def __init__(self, tick, size, origin):
+        self.tick = tick
+        self.size = size
+        self.origin = origin
+        self.current = 0
+        self.slots = [[] for _ in range(size)]
+
+    def add(self, item, when):
+        """Add item to fire on the first tick at or after ``when``"""
+        tick = max(int(math.ceil((when - self.origin) / self.tick)), self.current + 1)
+        self.slots[tick % self.size].append((tick, item))
+
+    def advance(self, now):
+        """Move up to ``now`` and return the items due, in tick order"""
+        target = int((now - self.origin) / self.tick)
+        if target - self.current >= self.size:
+            # Stalled for a revolution or more, every slot is due once
+            due = []
+            for index, slot in enumerate(self.slots):
+                self.slots[index] = [entry for entry in slot if entry[0] > target]
+                due.extend(entry for entry in slot if entry[0] <= target)
+            self.current = target
+            return [item for tick, item in sorted(due, key=lambda entry: entry[0])]
+
+        due = []
+        while self.current < target:
+            self.current += 1
+            index = self.current % self.size
+            slot = self.slots[index]
+            if slot:
+                self.slots[index] = [entry for entry in slot if entry[0] > self.current]
+                due.extend(item for tick, item in slot if tick <= self.current)
+        return due
+
+    def next_tick(self):
+        return self.origin + (self.current + 1) * self.tick
+
+
+class ScheduledWorker(BaseWorker):
+    """Runs the tasks of a ScheduleRegistry from one timer wheel
+
+    Each run is scheduled from the previous scheduled time rather than from when it
+    finished, so runs don't drift; runs missed while the worker was busy or down are
+    skipped, not caught up. A run that is still going when the next one is due makes
+    that one skip, so a task never overlaps itself. Up to ``concurrency`` tasks run
+    at a time; due runs beyond that are queued, in order, until a run finishes.
+
+    Per task, run times go into the ``task_seconds`` histogram and the delay from the
+    scheduled time into the ``task_lag_seconds`` gauge; ``task_runs``,
+    ``task_failures`` and ``task_skipped`` count the runs, and the ``tasks_queued``
+    gauge the runs waiting for a free slot.
+
+    Whether a task is running or queued is kept by the worker, not on the shared
+    tasks, so several workers can run the same registry.
+    """
+    registry = schedule_registry
+    tick = 1.0
+    wheel_size = 3600
+    concurrency = 10
+    drain_timeout = 10
+    pool = None
+
+    def get_tasks(self):
+        return self.registry.tasks
+
+    def setup(self):
+        now = time.time()
+        self.pool = Pool(self.concurrency)
+        self.due = deque()
+        self.queued = set()
+        self.running = {}
+        self.wheel = TimerWheel(self.tick, self.wheel_size, now)
+        for task in self.get_tasks():
+            next_at = task.schedule.next_after(now)
+            self.wheel.add((task, next_at), next_at)
+
+    def handle(self):
+        now = time.time()
+        for task, scheduled_at in self.wheel.advance(now):
+            self.run_task(task, scheduled_at, now)
+        self.start_due()
+
+        delay = max(0.0, self.wheel.next_tick() - time.time())
+        if self.due:
+            # Come back as soon as a slot frees up
+            start = time.time()
+            self.pool.wait_available(timeout=delay)
+            self.idle_seconds += time.time() - start
+        else:
+            self.wait(delay)
+        self.done()
+
+    def run_task(self, task, scheduled_at, now):
+        next_at = task.schedule.next_after(scheduled_at)
+        if next_at <= now:
+            next_at = task.schedule.next_after(now)
+        self.wheel.add((task, next_at), next_at)
+
+        if self.is_running(task):
+            logger.warning('skipping scheduled task %s, still %s', task.name,
+                           'queued' if task in self.queued else 'running')
+            self.metrics.counter('task_skipped', task=task.name).inc()
+            return
+        self.queued.add(task)
+        self.due.append((task, scheduled_at))
+
+    def is_running(self, task):
+        """Whether a run of the task is queued or still going in this worker"""
+        greenlet = self.running.get(task)
+        return task in self.queued or (greenlet is not None and not greenlet.dead)
+
+    def start_due(self):
+        while self.due and self.pool.free_count():
+            task, scheduled_at = self.due.popleft()
+            self.queued.discard(task)
+            self.running[task] = self.pool.spawn(self.call_task, task, scheduled_at)
+        self.metrics.gauge('tasks_queued').set(len(self.due))
+
+    def call_task(self, task, scheduled_at):
+        start = time.time()
+        self.metrics.gauge('task_lag_seconds', task=task.name).set(start - scheduled_at)
+        try:
+            task.func()
+        except Exception as exc:
+            logger.error('scheduled task %s failed: %r', task.name, exc, exc_info=True)
+            sentry.captureException()
+            self.metrics.counter('task_failures', task=task.name).inc()
+        else:
+            self.metrics.counter('task_runs', task=task.name).inc()
+        finally:
+            self.metrics.histogram('task_seconds', task=task.name).observe(time.time() - start)
+            self.count_handled()
+
+    def teardown(self):
+        if self.pool is not None:
+            self.pool.join(timeout=shutdown.remaining(self.drain_timeout))
+            self.pool.kill()
+            self.pool = None
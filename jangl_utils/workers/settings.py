@@ -0,0 +1,43 @@
+import socket
+
+from prettyconf import config, casts
+
+try:
+    from django.conf import settings as django_settings
+except ImportError:
+    django_settings = None
+
+
+# A name for this process that survives restarts, e.g. a StatefulSet pod name
+WORKER_IDENTITY = getattr(django_settings, 'WORKER_IDENTITY',
+                          config('WORKER_IDENTITY', default=socket.gethostname()))
+
+# Log a stack trace when the gevent hub is blocked for longer than this many seconds
+MAX_BLOCKING_TIME = getattr(django_settings, 'WORKER_MAX_BLOCKING_TIME',
+                            config('WORKER_MAX_BLOCKING_TIME', default=None, cast=lambda value: value and float(value)))
+
+# Port of the health and metrics endpoint of the workers command, off when unset
+HEALTH_PORT = getattr(django_settings, 'WORKER_HEALTH_PORT',
+                      config('WORKER_HEALTH_PORT', default=None, cast=lambda value: value and int(value)))
+# Seconds without a done() call before a running worker counts as stuck
+HEALTH_STALE_AFTER = getattr(django_settings, 'WORKER_HEALTH_STALE_AFTER',
+                             config('WORKER_HEALTH_STALE_AFTER', default=60, cast=float))
+
+# Seconds a worker process gets after SIGTERM to finish in-flight work, flush producers and commit
+SHUTDOWN_TIMEOUT = getattr(django_settings, 'WORKER_SHUTDOWN_TIMEOUT',
+                           config('WORKER_SHUTDOWN_TIMEOUT', default=30, cast=float))
+
+# Native threads of the pool run_in_threadpool() hands blocking calls to
+THREADPOOL_SIZE = getattr(django_settings, 'WORKER_THREADPOOL_SIZE',
+                          config('WORKER_THREADPOOL_SIZE', default=10, cast=int))
+
+# Recycle the worker process, or its workers in place without --processes, once its resident
+# memory is over this many megabytes, off when unset
+MAX_RSS_MB = getattr(django_settings, 'WORKER_MAX_RSS_MB',
+                     config('WORKER_MAX_RSS_MB', default=None, cast=lambda value: value and float(value)))
+# Seconds between two checks of the resident memory
+MEMORY_CHECK_INTERVAL = getattr(django_settings, 'WORKER_MEMORY_CHECK_INTERVAL',
+                                config('WORKER_MEMORY_CHECK_INTERVAL', default=30, cast=float))
+# Trace allocations with tracemalloc and log where memory grew when recycling, Python 3 only
+TRACE_MEMORY = getattr(django_settings, 'WORKER_TRACE_MEMORY',
+                       config('WORKER_TRACE_MEMORY', default=False, cast=casts.Boolean()))
@@ -0,0 +1,49 @@
+import time
+
+from jangl_utils import logger, sentry
+
+__all__ = ['register_shutdown_hook', 'begin_shutdown', 'is_shutting_down', 'remaining', 'run_shutdown_hooks']
+
+_deadline = None
+_hooks = []
+_hooks_run = False
+
+
+def register_shutdown_hook(func):
+    """Call func(timeout) once the workers of this process have stopped
+
+    timeout is the number of seconds left until the shutdown deadline, or None when
+    the workers stopped without a shutdown being requested.
+    """
+    if func not in _hooks:
+        _hooks.append(func)
+    return func
+
+
+def begin_shutdown(timeout):
+    """Start the shutdown clock, the process should be gone ``timeout`` seconds from now"""
+    global _deadline
+    if _deadline is None:
+        _deadline = time.time() + timeout
+        logger.info('shutting down within %ds', timeout)
+
+
+def is_shutting_down():
+    return _deadline is not None
+
+
+def remaining(default=None):
+    """Seconds left until the shutdown deadline, or ``default`` when not shutting down"""
+    if _deadline is None:
+        return default
+    return max(0.0, _deadline - time.time())
+
+
+def run_shutdown_hooks():
+    global _hooks_run
+    if _hooks_run:
+        return
+    _hooks_run = True
+    for hook in _hooks:
+        with sentry.capture_on_error(raise_error=False):
+            hook(remaining())
@@ -0,0 +1,71 @@
+import functools
+import os
+import sys
+import time
+
+import six
+from gevent.threadpool import ThreadPool
+
+from jangl_utils.workers import settings
+from jangl_utils.workers.metrics import process_metrics
+
+__all__ = ['get_threadpool', 'reset_threadpool', 'run_in_threadpool', 'in_threadpool']
+
+_threadpool = None
+
+
+def get_threadpool():
+    """The process wide pool of THREADPOOL_SIZE native threads, created on first use"""
+    global _threadpool
+    if _threadpool is None:
+        _threadpool = ThreadPool(settings.THREADPOOL_SIZE)
+    return _threadpool
+
+
+def reset_threadpool():
+    """Forget the pool after a fork, its threads only exist in the parent"""
+    global _threadpool
+    _threadpool = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_threadpool)
+
+
+def run_in_threadpool(fn, *args, **kwargs):
+    """Call fn on a native thread and return its result, the calling greenlet waits
+
+    Use it for blocking calls that don't yield to the gevent hub, C extensions
+    mostly, so other greenlets keep running meanwhile. Exceptions are raised in the
+    caller. ``threadpool_queue_depth`` gauges the calls waiting for a thread and
+    ``threadpool_wait_seconds`` how long they waited.
+    """
+    pool = get_threadpool()
+    started = []
+
+    def call():
+        started.append(time.time())
+        # Hand errors back rather than raising them, the hub would print them as unhandled
+        try:
+            return True, fn(*args, **kwargs)
+        except BaseException:
+            return False, sys.exc_info()
+
+    queued = time.time()
+    result = pool.spawn(call)
+    process_metrics.gauge('threadpool_queue_depth').set(pool.task_queue.qsize())
+    try:
+        ok, value = result.get()
+    finally:
+        if started:
+            process_metrics.histogram('threadpool_wait_seconds').observe(started[0] - queued)
+    if not ok:
+        six.reraise(*value)
+    return value
+
+
+def in_threadpool(fn):
+    """Decorator making every call of fn go through run_in_threadpool"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return run_in_threadpool(fn, *args, **kwargs)
+    return wrapper